@@ -0,0 +1,64 @@
+# Stand-in for the MicroPython machine module, backed by the simulated board
+
+import os
+import sys
+import threading
+import time
+
+
+class SoftReset(SystemExit):
+    """Raised to unwind the firmware when it asks for a reset"""
+    # MicroPython also unwinds with SystemExit, which asyncio lets escape
+    # from the tasks rather than just ending the one that raised it
+    def __init__(self, hard=False):
+        super().__init__("hard reset" if hard else "soft reset")
+        self.hard = hard
+
+
+# Watchdogs survive a soft reset, just as on the real hardware
+_watchdogs = []
+
+
+class WDT:
+    def __init__(self, id=0, timeout=5000):
+        # There is only one watchdog, so a new WDT object takes over from any older one
+        disarm_watchdogs()
+        self._timeout = timeout / 1000.0
+        self._last_feed = time.monotonic()
+        self._armed = True
+        self.max_interval = 0.0
+        _watchdogs.append(self)
+        t = threading.Thread(target=self._watch, daemon=True, name="WDT")
+        t.start()
+
+    def feed(self):
+        now = time.monotonic()
+        self.max_interval = max(self.max_interval, now - self._last_feed)
+        self._last_feed = now
+
+    def _watch(self):
+        while self._armed:
+            remaining = self._last_feed + self._timeout - time.monotonic()
+            if remaining <= 0:
+                # A real watchdog resets the MCU, dropping the USB connection;
+                # a hung firmware thread can not be unwound, so stop the process
+                print("Watchdog timeout after {:.1f}s; resetting board".format(self._timeout),
+                      file=sys.stderr)
+                sys.stderr.flush()
+                os._exit(3)
+            time.sleep(min(remaining, 0.5))
+
+
+def disarm_watchdogs():
+    """Stop all watchdogs, as happens when the board is hard reset"""
+    for w in _watchdogs:
+        w._armed = False
+    del _watchdogs[:]
+
+
+def reset():
+    raise SoftReset(hard=True)
+
+
+def soft_reset():
+    raise SoftReset()
@@ -0,0 +1,50 @@
+# Stand-in for the MicroPython micropython module
+
+import threading
+
+# Depth of the scheduler queue in the standard MicroPython build
+SCHEDULE_QUEUE_SIZE = 8
+
+_pending = 0
+_lock = threading.Lock()
+
+
+def schedule(fn, arg):
+    # There is no way to run code between the main thread's bytecodes, so
+    # the function runs straight away on the thread that scheduled it,
+    # usually a timer thread standing in for an interrupt
+    global _pending
+    with _lock:
+        if _pending >= SCHEDULE_QUEUE_SIZE:
+            raise RuntimeError("schedule queue full")
+        _pending += 1
+    try:
+        fn(arg)
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+def const(x):
+    return x
+
+
+def native(fn):
+    return fn
+
+
+def viper(fn):
+    return fn
+
+
+def kbd_intr(c):
+    # Control-C on the pseudo-terminal is always passed through as input
+    pass
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def mem_info(verbose=False):
+    pass
@@ -0,0 +1,153 @@
+# Stand-in for the MicroPython pyb module, backed by the simulated board
+
+import threading
+import time
+
+import simboard
+
+
+def _board():
+    if simboard.board is None:
+        raise RuntimeError("No simulated board has been set up")
+    return simboard.board
+
+
+class Pin:
+    IN = 0
+    OUT_PP = 1
+    OUT_OD = 2
+    PULL_NONE = 0
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, name, mode=IN, pull=PULL_NONE):
+        self._name = name.name() if isinstance(name, Pin) else name
+        self._mode = mode
+        if mode != Pin.IN:
+            _board().set_pin(self._name, 0)
+
+    def name(self):
+        return self._name
+
+    def value(self, *v):
+        if v:
+            _board().set_pin(self._name, v[0])
+            return None
+        return _board().get_pin(self._name)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+
+class ADC:
+    def __init__(self, pin):
+        self._name = pin.name() if isinstance(pin, Pin) else pin
+
+    def read(self):
+        return _board().read_adc(self._name)
+
+    @staticmethod
+    def read_timed_multi(adcs, bufs, timer):
+        # Fill the buffers with interleaved samples, taking as long as the hardware would
+        n = len(bufs[0])
+        for i in range(n):
+            for adc, buf in zip(adcs, bufs):
+                buf[i] = adc.read()
+        time.sleep(n / timer.freq())
+        return True
+
+
+class LED:
+    def __init__(self, n):
+        self._n = n
+        self._on = False
+
+    def on(self):
+        self._on = True
+
+    def off(self):
+        self._on = False
+
+    def toggle(self):
+        self._on = not self._on
+
+    def intensity(self, *v):
+        if v:
+            self._on = bool(v[0])
+            return None
+        return 255 if self._on else 0
+
+
+class Timer:
+    """A timer whose callback runs on a thread, much as an IRQ preempts the main loop"""
+    def __init__(self, n, freq=None):
+        self._n = n
+        self._cb = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._period = None
+        if freq is not None:
+            self.init(freq=freq)
+
+    def init(self, freq=None, period=None, prescaler=None):
+        self.deinit()
+        self._period = (1.0 / freq) if freq else (period / 1000000.0)
+        _board().timers.add(self)
+
+    def _start(self):
+        # Only run a thread while there is a callback, since timers used
+        # just to pace the ADC can run at many kilohertz
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), daemon=True,
+                                        name="Timer{}".format(self._n))
+        self._thread.start()
+
+    def _run(self, stop):
+        while not stop.wait(self._period):
+            cb = self._cb
+            if cb:
+                try:
+                    cb(self)
+                except Exception as e:
+                    print("uncaught exception in Timer({}) interrupt handler: {}: {}".format(
+                        self._n, e.__class__.__name__, e))
+                    self._cb = None
+
+    def callback(self, fn):
+        self._cb = fn
+        if fn and self._period and self._thread is None:
+            self._start()
+
+    def deinit(self):
+        self._cb = None
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        _board().timers.discard(self)
+
+    def freq(self):
+        return 1.0 / self._period if self._period else 0
+
+
+# The clock keeps running through resets, as it does on a board with a
+# backup battery; it starts at the host's local time
+_rtc_offset = 0.0
+
+
+class RTC:
+    def datetime(self, *dt):
+        global _rtc_offset
+        if dt:
+            y, mo, d, wd, h, mi, s, sub = dt[0]
+            _rtc_offset = time.mktime((y, mo, d, h, mi, s, 0, 0, -1)) - time.time()
+            return None
+        t = time.localtime(time.time() + _rtc_offset)
+        return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_wday + 1, t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+
+def USB_VCP():
+    return _board().serial
@@ -0,0 +1,178 @@
+# Simulated MultiTherm hardware for running the firmware under CPython
+
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+zeroCK = 273.15
+
+HARDWARE_CHANNELS = 8
+
+# The thermistors are on pins X1 through X8, ascending
+ADC_PIN_NAMES = ["X{}".format(i+1) for i in range(HARDWARE_CHANNELS)]
+# The relays are on pins Y8 to Y1, descending
+RELAY_PIN_NAMES = ["Y{}".format(8-i) for i in range(HARDWARE_CHANNELS)]
+# The DIP switches are on pins X12 (bit 0) to X9 (bit 3) and pull to ground
+DIP_PIN_NAMES = ["X{}".format(12-i) for i in range(4)]
+
+# Default thermal model for each channel
+DEFAULT_AMBIENT = 10.0
+DEFAULT_INITIAL = 18.0
+# Rate at which a channel warms when its relay is closed, in C per second
+DEFAULT_HEAT_RATE = 0.02
+# Time constant for heat loss to the ambient temperature, in seconds
+DEFAULT_LOSS_TAU = 3600.0
+# Standard deviation of the ADC noise, in counts
+DEFAULT_NOISE = 2.0
+
+# Thermistor and divider values, matching the firmware defaults
+DEFAULT_R_NOMINAL = 10000
+DEFAULT_NOMINAL_TEMP = 25
+DEFAULT_BETA = 3844.0507496971973
+DEFAULT_R_REF = 10000
+
+
+class ChannelModel:
+    """First order thermal model of a single heated zone"""
+    def __init__(self, ambient=DEFAULT_AMBIENT, initial=DEFAULT_INITIAL,
+                 heat_rate=DEFAULT_HEAT_RATE, loss_tau=DEFAULT_LOSS_TAU,
+                 noise=DEFAULT_NOISE):
+        self.ambient = ambient
+        self.temp = initial
+        self.heat_rate = heat_rate
+        self.loss_tau = loss_tau
+        self.noise = noise
+
+    def advance(self, dt, heating):
+        # With the relay state constant over the interval the model has
+        # an exact solution, so large steps are as accurate as small ones
+        t_eq = self.ambient + (self.heat_rate * self.loss_tau if heating else 0.0)
+        self.temp = t_eq + (self.temp - t_eq) * math.exp(-dt / self.loss_tau)
+
+
+class VirtualSerial:
+    """A pseudo-terminal standing in for the pyboard USB serial port"""
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        # The host end must not echo or translate what the firmware sends
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.io_time = 0.0
+
+    def fileno(self):
+        return self.master
+
+    def write(self, data):
+        t0 = time.perf_counter()
+        if isinstance(data, str):
+            data = data.encode("UTF8")
+        n = len(data)
+        data = memoryview(data)
+        while data:
+            data = data[os.write(self.master, data):]
+        self.io_time += time.perf_counter() - t0
+        return n
+
+    def any(self):
+        t0 = time.perf_counter()
+        rl, _, _ = select.select([self.master], [], [], 0)
+        self.io_time += time.perf_counter() - t0
+        return 1 if rl else 0
+
+    def read(self, n=4096):
+        t0 = time.perf_counter()
+        try:
+            if not self.any():
+                return None
+            return os.read(self.master, n)
+        finally:
+            self.io_time += time.perf_counter() - t0
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        if not data:
+            return None
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class SimBoard:
+    """The state of the simulated pyboard and the room it is heating"""
+    def __init__(self, board_id=0, channels=None, speed=1.0,
+                 beta=DEFAULT_BETA, r_ref=DEFAULT_R_REF,
+                 r_nominal=DEFAULT_R_NOMINAL, nominal_temp=DEFAULT_NOMINAL_TEMP,
+                 seed=None):
+        if board_id < 0 or board_id > 15:
+            raise ValueError("Board ID must be between 0 and 15")
+        self.board_id = board_id
+        self.channels = channels if channels else [ChannelModel() for i in range(HARDWARE_CHANNELS)]
+        if len(self.channels) != HARDWARE_CHANNELS:
+            raise ValueError("Model must have {} channels".format(HARDWARE_CHANNELS))
+        self.speed = speed
+        self.beta = beta
+        self.r_ref = r_ref
+        self.r_inf = r_nominal * math.exp(-beta/(nominal_temp + zeroCK))
+        self.random = random.Random(seed)
+        self.pin_values = {}
+        self.timers = set()
+        self.serial = VirtualSerial()
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._model_time = 0.0
+        for i, p in enumerate(DIP_PIN_NAMES):
+            # Switches connect the pin to ground when on
+            self.pin_values[p] = 0 if (board_id >> i) & 1 else 1
+
+    def sim_time(self):
+        """Seconds of simulated time since the board was created"""
+        return (time.monotonic() - self._start) * self.speed
+
+    def _advance_model(self):
+        with self._lock:
+            now = self.sim_time()
+            dt = now - self._model_time
+            if dt <= 0:
+                return
+            self._model_time = now
+            for relay, model in zip(RELAY_PIN_NAMES, self.channels):
+                model.advance(dt, self.pin_values.get(relay, 0))
+
+    def read_adc(self, pin_name):
+        self._advance_model()
+        model = self.channels[ADC_PIN_NAMES.index(pin_name)]
+        r = self.r_inf * math.exp(self.beta / (model.temp + zeroCK))
+        v = r / (r + self.r_ref)
+        count = int(round(v * 4096 + self.random.gauss(0, model.noise)))
+        return min(max(count, 0), 4095)
+
+    def set_pin(self, pin_name, value):
+        if pin_name in RELAY_PIN_NAMES:
+            # Bring the model up to date before the heating state changes
+            self._advance_model()
+        self.pin_values[pin_name] = 1 if value else 0
+
+    def get_pin(self, pin_name):
+        return self.pin_values.get(pin_name, 0)
+
+    def temperatures(self):
+        self._advance_model()
+        return [m.temp for m in self.channels]
+
+    def relays(self):
+        return [self.get_pin(p) for p in RELAY_PIN_NAMES]
+
+    def stop_timers(self):
+        for t in list(self.timers):
+            t.deinit()
+
+
+# The board being emulated; set up by the emulator before the firmware is imported
+board = None
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# Run the multitherm firmware under CPython against a simulated pyboard
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import select
+import sys
+import tempfile
+import time
+import traceback
+from collections import defaultdict
+from os.path import abspath, dirname, join
+
+emulator_root = dirname(abspath(__file__))
+if emulator_root not in sys.path:
+    sys.path.insert(0, emulator_root)
+
+import simboard
+from simboard import SimBoard, ChannelModel
+
+default_firmware = join(dirname(emulator_root), "micropython", "multitherm.py")
+
+# Rough size of the MicroPython heap on a pyboard, used for gc.mem_free()
+HEAP_SIZE = 100 * 1024
+
+
+class BenchmarkDone(SystemExit):
+    # Must escape from the firmware's asyncio tasks, as SoftReset does
+    pass
+
+
+class FlashFS:
+    """Maps the pyboard's /flash file system into a local directory"""
+    def __init__(self, root):
+        self.root = root
+        self.sep = "/"
+
+    def path(self, p):
+        if p.startswith("/flash/"):
+            p = p[len("/flash/"):]
+        elif p == "/flash":
+            p = ""
+        return join(self.root, p.lstrip("/"))
+
+    def open(self, p, mode="r", *args, **kwargs):
+        return open(self.path(p), mode, *args, **kwargs)
+
+    def stat(self, p):
+        return tuple(os.stat(self.path(p)))
+
+    def listdir(self, p=""):
+        return os.listdir(self.path(p))
+
+    def remove(self, p):
+        os.remove(self.path(p))
+
+    def rename(self, a, b):
+        os.rename(self.path(a), self.path(b))
+
+    def mkdir(self, p):
+        os.mkdir(self.path(p))
+
+    def sync(self):
+        pass
+
+
+class TimeShim:
+    """The parts of MicroPython's time module that are missing from CPython"""
+    TICKS_PERIOD = 1 << 30
+
+    def time(self):
+        # MicroPython returns an integer number of seconds
+        return int(time.time())
+
+    def sleep(self, s):
+        time.sleep(s)
+
+    def sleep_ms(self, ms):
+        self.sleep(ms / 1000.0)
+
+    def sleep_us(self, us):
+        self.sleep(us / 1000000.0)
+
+    def ticks_ms(self):
+        return int(time.monotonic() * 1000) % self.TICKS_PERIOD
+
+    def ticks_us(self):
+        return int(time.monotonic() * 1000000) % self.TICKS_PERIOD
+
+    def ticks_cpu(self):
+        return time.perf_counter_ns() % self.TICKS_PERIOD
+
+    def ticks_add(self, ticks, delta):
+        return (ticks + delta) % self.TICKS_PERIOD
+
+    def ticks_diff(self, ticks1, ticks2):
+        half = self.TICKS_PERIOD // 2
+        return ((ticks1 - ticks2 + half) % self.TICKS_PERIOD) - half
+
+    def localtime(self, secs=None):
+        return time.localtime(secs)[:8]
+
+    def mktime(self, t):
+        return int(time.mktime(tuple(t[:8]) + (-1,)))
+
+
+class SysShim:
+    def __init__(self):
+        self.implementation = sys.implementation
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+
+    def print_exception(self, e, file=None):
+        traceback.print_exception(type(e), e, e.__traceback__, file=file or sys.stderr)
+
+    def exit(self, code=0):
+        sys.exit(code)
+
+
+class GCShim:
+    def __init__(self, profiler=None):
+        self._profiler = profiler
+        self._baseline = sys.getallocatedblocks()
+
+    def collect(self):
+        t0 = time.perf_counter()
+        gc.collect()
+        self._baseline = sys.getallocatedblocks()
+        if self._profiler:
+            self._profiler.add("gc", time.perf_counter() - t0)
+
+    def mem_alloc(self):
+        # CPython does not have a fixed heap, so estimate from the growth
+        # in the block count since the last collection
+        return max(0, sys.getallocatedblocks() - self._baseline) * 16
+
+    def mem_free(self):
+        return max(0, HEAP_SIZE - self.mem_alloc())
+
+    def enable(self):
+        gc.enable()
+
+    def disable(self):
+        gc.disable()
+
+    def threshold(self, *args):
+        return -1
+
+
+class LoopProfiler:
+    """Collects per-iteration costs of the firmware main loop"""
+    def __init__(self, iterations, serial, commands=(), every=1):
+        self.target = iterations
+        self.serial = serial
+        self.commands = [c.encode("ASCII") + b"\r" for c in commands]
+        self.every = every
+        self.iterations = 0
+        self.samples = defaultdict(list)
+        self._current = defaultdict(float)
+        self._io_start = 0.0
+        self._wake = None
+
+    def add(self, category, dt):
+        self._current[category] += dt
+
+    def wrap(self, category, fn):
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._current[category] += time.perf_counter() - t0
+        return timed
+
+    def wrap_loop(self, fn):
+        # Each run of the control step starts a new iteration
+        def step(*args, **kwargs):
+            self.loop_step()
+            return fn(*args, **kwargs)
+        return step
+
+    def loop_step(self):
+        now = time.perf_counter()
+        if self._wake is not None:
+            self.samples["loop"].append(now - self._wake)
+            self._current["serial"] = self.serial.io_time - self._io_start
+            for k in ("gc", "check", "command", "serial"):
+                self.samples[k].append(self._current[k])
+            self.iterations += 1
+            if self.iterations >= self.target:
+                raise BenchmarkDone()
+        self._current.clear()
+        self._drain()
+        if self.commands and self.iterations % self.every == 0:
+            self._feed()
+        self._io_start = self.serial.io_time
+        self._wake = time.perf_counter()
+
+    def _drain(self):
+        while select.select([self.serial.slave], [], [], 0)[0]:
+            os.read(self.serial.slave, 4096)
+
+    def _feed(self):
+        for c in self.commands:
+            os.write(self.serial.slave, c)
+        # Wait for the pty to pass the data through, so that the loop sees it
+        select.select([self.serial.master], [], [], 0.05)
+
+    def report(self, out=sys.stdout):
+        labels = [("loop", "loop iteration"),
+                  ("gc", "gc.collect"),
+                  ("check", "thermostat checks"),
+                  ("command", "command processing"),
+                  ("serial", "serial I/O")]
+        print("Firmware main loop benchmark: {} iterations, {} injected command(s) every {} iteration(s)".format(
+            self.iterations, len(self.commands), self.every), file=out)
+        print("{:20s} {:>10s} {:>10s} {:>10s} {:>10s}   (microseconds)".format(
+            "", "mean", "p50", "p95", "max"), file=out)
+        for k, label in labels:
+            v = sorted(self.samples[k])
+            if not v:
+                continue
+            n = len(v)
+            print("{:20s} {:10.1f} {:10.1f} {:10.1f} {:10.1f}".format(
+                label, 1e6 * sum(v) / n, 1e6 * v[n // 2], 1e6 * v[min(n - 1, (n * 95) // 100)], 1e6 * v[-1]),
+                  file=out)
+
+
+def load_firmware(path, flash, profiler=None):
+    spec = importlib.util.spec_from_file_location("multitherm", path)
+    fw = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fw)
+    # Give the firmware the MicroPython flavour of the standard modules
+    fw.time = TimeShim()
+    fw.sys = SysShim()
+    fw.gc = GCShim(profiler)
+    fw.os = flash
+    fw.open = flash.open
+    if profiler:
+        fw.asyncio.skip_sleeps = True
+        fw.CommandLine._control_step = profiler.wrap_loop(fw.CommandLine._control_step)
+        fw.Thermostat.check = profiler.wrap("check", fw.Thermostat.check)
+        fw.CommandLine._process_command = profiler.wrap("command", fw.CommandLine._process_command)
+    return fw
+
+
+def load_model(args):
+    defaults = {"ambient": args.ambient,
+                "initial": args.initial,
+                "heat_rate": args.heat_rate,
+                "loss_tau": args.loss_tau,
+                "noise": args.noise}
+    per_channel = [{} for i in range(simboard.HARDWARE_CHANNELS)]
+    if args.model:
+        with open(args.model) as fh:
+            m = json.load(fh)
+        for i, c in enumerate(m[:simboard.HARDWARE_CHANNELS]):
+            per_channel[i] = c
+    return [ChannelModel(**dict(defaults, **c)) for c in per_channel]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the multitherm firmware on an emulated pyboard')
+    parser.add_argument('--firmware', '-f', metavar="PATH", default=default_firmware,
+                        help="path to the firmware source")
+    parser.add_argument('--id', '-i', metavar="ID", type=int, default=0,
+                        help="board ID as set on the DIP switches (0 to 15)")
+    parser.add_argument('--flash', metavar="DIR",
+                        help="directory holding the contents of /flash (default: a temporary directory)")
+    parser.add_argument('--debug', '-D', action="store_true",
+                        help="allow the EXIT command and disable the watchdog")
+    parser.add_argument('--speed', '-s', type=float, default=1.0,
+                        help="rate at which simulated time passes for the thermal model")
+    parser.add_argument('--seed', type=int,
+                        help="seed for the ADC noise generator")
+    parser.add_argument('--model', '-m', metavar="JSON_FILE",
+                        help="file with a list of per-channel thermal model parameters")
+    parser.add_argument('--ambient', type=float, default=simboard.DEFAULT_AMBIENT,
+                        help="temperature to which unheated zones settle")
+    parser.add_argument('--initial', type=float, default=simboard.DEFAULT_INITIAL,
+                        help="starting temperature of every zone")
+    parser.add_argument('--heat-rate', type=float, default=simboard.DEFAULT_HEAT_RATE,
+                        help="warming rate of a heated zone in C per second")
+    parser.add_argument('--loss-tau', type=float, default=simboard.DEFAULT_LOSS_TAU,
+                        help="time constant of heat loss in seconds")
+    parser.add_argument('--noise', type=float, default=simboard.DEFAULT_NOISE,
+                        help="standard deviation of ADC noise in counts")
+    parser.add_argument('--benchmark', '-b', metavar="N", type=int,
+                        help="run N iterations of the control task without sleeping and report their cost")
+    parser.add_argument('--bench-command', '-c', metavar="CMD", action='append', default=[],
+                        help="command to send to the firmware during the benchmark")
+    parser.add_argument('--bench-every', metavar="K", type=int, default=1,
+                        help="send the benchmark commands every K iterations")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    flash_dir = args.flash if args.flash else tempfile.mkdtemp(prefix="multitherm-flash-")
+    flash = FlashFS(flash_dir)
+
+    simboard.board = SimBoard(board_id=args.id, channels=load_model(args), speed=args.speed, seed=args.seed)
+    serial = simboard.board.serial
+    profiler = LoopProfiler(args.benchmark, serial, args.bench_command, args.bench_every) if args.benchmark else None
+
+    import machine
+
+    print("Emulating board ID {} on {} (flash in {})".format(args.id, serial.path, flash_dir))
+    sys.stdout.flush()
+
+    while True:
+        fw = load_firmware(args.firmware, flash, profiler)
+        try:
+            fw.run(exit_allowed=args.debug, wdt_timeout=None if args.debug else 10)
+            print("Firmware command loop exited")
+            break
+        except machine.SoftReset as r:
+            print("Firmware requested {}".format(r))
+            if r.hard:
+                machine.disarm_watchdogs()
+        except BenchmarkDone:
+            profiler.report()
+            break
+        except KeyboardInterrupt:
+            break
+        finally:
+            simboard.board.stop_timers()
+
+
+if __name__ == "__main__":
+    main()
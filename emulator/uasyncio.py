@@ -0,0 +1,63 @@
+# Stand-in for MicroPython's uasyncio, built on the CPython asyncio module
+
+import asyncio
+import traceback
+from asyncio import *
+
+# Set by the emulator's benchmark mode, so that tasks run back to back
+skip_sleeps = False
+
+
+async def sleep(t):
+    await asyncio.sleep(0 if skip_sleeps else t)
+
+
+async def sleep_ms(t):
+    await sleep(t / 1000.0)
+
+
+def _task_done(t):
+    # Report a task's exception straight away, as MicroPython does. Resets
+    # escape from the event loop and are handled by the emulator.
+    if t.cancelled():
+        return
+    e = t.exception()
+    if e is not None and not isinstance(e, SystemExit):
+        print("Task exception wasn't retrieved")
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+
+def create_task(coro):
+    t = asyncio.create_task(coro)
+    t.add_done_callback(_task_done)
+    return t
+
+
+class StreamReader:
+    """Reads from an object with a file descriptor, waking when data arrives"""
+    def __init__(self, s):
+        self.s = s
+
+    async def read(self, n=-1):
+        while True:
+            data = self.s.read(n if n > 0 else 4096)
+            if data:
+                return data
+            await self._readable()
+
+    async def readinto(self, buf):
+        while True:
+            n = self.s.readinto(buf)
+            if n:
+                return n
+            await self._readable()
+
+    async def _readable(self):
+        loop = asyncio.get_running_loop()
+        fd = self.s.fileno()
+        ready = loop.create_future()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
@@ -15,6 +15,8 @@
 # permissions and limitations under the License.
 
 import machine
+import micropython
+from micropython import const
 import pyb
 import math
 import time
@@ -22,8 +24,15 @@ import sys
 import json
 import gc
 import os
+import struct
+import array
+import binascii
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
-__version__ = "0.6.1"
+__version__ = "0.20.0"
 
 zeroCK = 273.15
 
@@ -32,6 +41,15 @@ DEFAULT_SET_POINT=20.0
 DEFAULT_DEAD_ZONE = 1.0
 DEFAULT_MONITOR = 0
 
+# Default ASYNC reporting policy for each channel: the temperature change
+# that is reported, the minimum interval between temperature reports, the
+# maximum interval between reports (0 for none) in seconds, and whether
+# only output changes are reported
+DEFAULT_REPORT_DEADBAND = 0.1
+DEFAULT_REPORT_MIN = 1
+DEFAULT_REPORT_MAX = 0
+DEFAULT_REPORT_EDGE = False
+
 HARDWARE_CHANNELS = 8
 
 # Default values for the thermistors and reference resistors
@@ -44,10 +62,327 @@ DEFAULT_BETA = 3844.0507496971973
 #  The value of the fixed resistor in the voltage divider
 DEFAULT_R_REF = 10000
 
+# Sampling of the thermistors. Every period a burst of samples is taken
+# from all the channels at the burst rate and the samples in each burst
+# are summed, giving extra bits of resolution and some noise rejection.
+# The oversampling count must be a power of two.
+DEFAULT_SAMPLE_PERIOD = 100
+DEFAULT_OVERSAMPLE = 16
+DEFAULT_BURST_FREQ = 8000
+SAMPLE_TIMER = 7
+BURST_TIMER = 6
+# The sampled values are low-pass filtered, keeping this many extra bits
+# of fraction, with a default time constant in seconds
+FILTER_BITS = const(5)
+DEFAULT_TIME_CONSTANT = 1.0
+MAX_TIME_CONSTANT = 60
+
+# Period of the thermostat control task, in milliseconds
+CONTROL_PERIOD = 100
+# Interval between feeding the watchdog, in milliseconds
+WDT_FEED_PERIOD = 1000
+# Sizes of the preallocated input and output buffers, and the most
+# tokens in a command line, which may hold several commands
+INPUT_BUFFER = 256
+OUTPUT_BUFFER = 1024
+MAX_TOKENS = 64
+# Garbage is collected at most this often, in milliseconds, unless free
+# memory drops below the reserve
+GC_INTERVAL = 10000
+GC_MIN_FREE = 16384
+
+# The sample history kept in RAM. The default of a day of samples at one
+# minute intervals uses about 24KB.
+DEFAULT_HISTORY_PERIOD = 60
+DEFAULT_HISTORY_LENGTH = 1440
+# The buffer is allocated at start up, so a length that doesn't fit in RAM
+# would stop the board from starting at all
+MAX_HISTORY_LENGTH = 2880
+# Each sample is the output states as a bit mask and the temperature of
+# every channel in hundredths of a degree
+HISTORY_RECORD_SIZE = 1 + 2 * HARDWARE_CHANNELS
+HISTORY_UNKNOWN = -32768
+
+# Loop statistics keep this many of the most recent samples of each
+# measurement, in microseconds
+LOOPSTATS_SAMPLES = 128
+STAT_LOOP = const(0)
+STAT_PERIOD = const(1)
+STAT_CHECK = const(2)
+STAT_IO = const(3)
+STAT_GC = const(4)
+
+# Weekly set-point schedules. Each channel has up to SCHEDULE_MAX
+# entries, each a mask of days of the week (bit 0 for Monday), a time of
+# day in minutes and a set point, which is applied at that time on each
+# of the days. A SET holds until the next entry comes due.
+SCHEDULE_MAX = 42
+MINUTES_PER_WEEK = 7 * 24 * 60
+# Schedules are not run until the clock has been set to a time in or
+# after this year
+RTC_MIN_YEAR = 2020
+
+# The configuration is saved in a compact binary form, rotating through
+# several slot files so that a failed write never loses the previous
+# configuration and the writes are spread over the flash. Each slot is
+# a header holding a magic number, a sequence number, the payload length
+# and the CRC32 of the payload, followed by the payload, padded to a
+# whole number of sectors. The payload is a series of sections, each a
+# tag byte and a length byte followed by the section data. Sections with
+# unknown tags are skipped.
+CONFIG_MAGIC = b"MTC1"
+CONFIG_HEADER = "<4sIHI"
+CONFIG_HEADER_SIZE = struct.calcsize(CONFIG_HEADER)
+CONFIG_SLOTS = 4
+CONFIG_SECTOR = 512
+CONFIG_GLOBAL = 1
+CONFIG_CHANNEL = 2
+CONFIG_SCHEDULE = 3
+CONFIG_REPORT = 4
+# Monitor period, channel count, history period and history length
+CONFIG_GLOBAL_RECORD = "<HBHH"
+# Channel index, then set point, dead zone, override, adjustment and
+# filter time constant, all but the override in hundredths
+CONFIG_CHANNEL_RECORD = "<BhhbhH"
+# A schedule section is the channel index followed by the entries, each
+# the days mask, the minute of the day and the set point in hundredths
+CONFIG_SCHEDULE_ENTRY = "<BHh"
+CONFIG_SCHEDULE_ENTRY_SIZE = struct.calcsize(CONFIG_SCHEDULE_ENTRY)
+# Channel index, then the reporting deadband in hundredths, the minimum
+# and maximum report intervals in seconds and the edge-only flag
+CONFIG_REPORT_RECORD = "<BhHHB"
+
+# Binary protocol framing. Each frame is the sync byte, a type byte, a
+# little-endian 16 bit command tag, a little-endian 16 bit payload
+# length, the payload and a little-endian 16 bit sum of the type, tag,
+# length and payload bytes.
+FRAME_HEADER_SIZE = 6
+FRAME_SYNC = 0xA5
+FRAME_RESPONSE = ord("R")
+FRAME_ERROR = ord("E")
+FRAME_STATE = ord("S")
+FRAME_ASYNC = ord("A")
+FRAME_MONITOR = ord("M")
+FRAME_HISTORY = ord("H")
+FRAME_END = ord("Z")
+FRAME_PAYLOAD_MAX = 256
+# Channel, temperature, set point, output, adjustment and override, with
+# temperatures in hundredths of a degree and -1 for no override
+STATE_RECORD = "<BhhBhb"
+STATE_RECORD_SIZE = struct.calcsize(STATE_RECORD)
+
 def debug(s):
     # pyb.USB_VCP().write("DEBUG {}\r\n".format(s))
     pass
     
+# Conversion tables from raw ADC counts to temperature in hundredths of
+# a degree Celsius, shared between thermistors with the same parameters
+ADC_COUNTS = 4096
+_temperature_tables = {}
+
+def _table_file(key):
+    return "/flash/lut-{:08x}.bin".format(binascii.crc32(struct.pack("<fff", *key)) & 0xffffffff)
+
+def _build_table(ref_R, beta, r_inf):
+    # One entry per ADC count, plus one more so that interpolation can
+    # always use the next entry
+    tab = array.array("h")
+    for c in range(ADC_COUNTS + 1):
+        v = min(c, ADC_COUNTS - 1) / ADC_COUNTS
+        r = v*ref_R/(1-v) if v else (ref_R/10000.0)
+        x = r/r_inf
+        t = (beta/math.log(x) - zeroCK) * 100 if x > 1 else 32767
+        tab.append(int(min(max(t, -32768), 32767)))
+    return tab
+
+def temperature_table(ref_R, beta, r_inf):
+    """Return the table of temperatures for each ADC count, in hundredths of a degree"""
+    key = (ref_R, beta, r_inf)
+    tab = _temperature_tables.get(key)
+    if tab is not None:
+        return tab
+    # Computing the table takes a noticeable time, so it is cached on flash
+    fn = _table_file(key)
+    tab = array.array("h", (0 for i in range(ADC_COUNTS + 1)))
+    try:
+        with open(fn, "rb") as fh:
+            if fh.readinto(tab) != len(tab) * 2:
+                raise ValueError
+    except:
+        debug("Building temperature table {}".format(fn))
+        tab = _build_table(ref_R, beta, r_inf)
+        try:
+            with open(fn, "wb") as fh:
+                fh.write(tab)
+        except:
+            debug("Could not save temperature table")
+    _temperature_tables[key] = tab
+    return tab
+
+def table_lookup(tab, x, frac_bits=0):
+    # Look up a value with frac_bits of fraction, interpolating between entries
+    i = x >> frac_bits
+    if not frac_bits:
+        return tab[i]
+    a = tab[i]
+    return a + (((tab[i+1] - a) * (x & ((1 << frac_bits) - 1))) >> frac_bits)
+
+@micropython.native
+def iir_filter(state, inputs, coeffs, n):
+    # First order low-pass filter: state += (input - state) * coeff / 65536,
+    # with the state holding FILTER_BITS more fraction than the input. The
+    # multiplication is split in two so that every intermediate value
+    # stays a small integer and nothing is allocated.
+    for i in range(n):
+        k = coeffs[i]
+        d = (inputs[i] << FILTER_BITS) - state[i]
+        state[i] += ((d >> 8) * k + (((d & 255) * k) >> 8)) >> 8
+
+class Sampler:
+    """Samples a set of ADCs in timed bursts and filters the burst sums"""
+    def __init__(self, adcs, period=DEFAULT_SAMPLE_PERIOD, oversample=DEFAULT_OVERSAMPLE,
+                 burst_freq=DEFAULT_BURST_FREQ):
+        if oversample & (oversample - 1):
+            raise ValueError("Oversampling must be a power of two")
+        self.period = period
+        self._adcs = tuple(adcs)
+        n = len(self._adcs)
+        self._bufs = tuple(array.array("H", (0 for i in range(oversample))) for a in self._adcs)
+        self.frac_bits = 0
+        while (1 << self.frac_bits) < oversample:
+            self.frac_bits += 1
+        self.values = array.array("l", (0 for i in range(n)))
+        self.filtered = array.array("l", (0 for i in range(n)))
+        self._coeffs = array.array("l", (0 for i in range(n)))
+        self.time_constants = [DEFAULT_TIME_CONSTANT] * n
+        for i in range(n):
+            self.set_time_constant(i, DEFAULT_TIME_CONSTANT)
+        self.channels = [SampledChannel(self, i) for i in range(n)]
+        self.bursts = 0
+        self.overruns = 0
+        self._burst_timer = pyb.Timer(BURST_TIMER, freq=burst_freq)
+        # Take the first burst now so that there are values to read, and
+        # start the filters from it
+        self._burst(None)
+        for i in range(n):
+            self.filtered[i] = self.values[i] << FILTER_BITS
+        # Keep a reference to the bound method so the interrupt does not allocate
+        self._burst_ref = self._burst
+        self._timer = pyb.Timer(SAMPLE_TIMER, freq=1000/period)
+        self._timer.callback(self._tick)
+
+    def set_time_constant(self, i, tc):
+        # The filter runs once per period, so its coefficient is fixed
+        self.time_constants[i] = tc
+        k = 1 - math.exp(-self.period / (1000 * tc)) if tc > 0 else 1
+        self._coeffs[i] = min(int(k * 65536 + 0.5), 65535)
+
+    def _tick(self, timer):
+        # The conversions take a couple of milliseconds, too long for an
+        # interrupt handler, so run them as soon as the main code allows
+        try:
+            micropython.schedule(self._burst_ref, None)
+        except RuntimeError:
+            # The schedule queue is full; skip this burst
+            self.overruns += 1
+
+    def _burst(self, _):
+        if not pyb.ADC.read_timed_multi(self._adcs, self._bufs, self._burst_timer):
+            self.overruns += 1
+        values = self.values
+        bufs = self._bufs
+        n = len(bufs)
+        for i in range(n):
+            values[i] = sum(bufs[i])
+        iir_filter(self.filtered, values, self._coeffs, n)
+        self.bursts += 1
+
+    def stop(self):
+        self._timer.deinit()
+        self._burst_timer.deinit()
+
+class SampledChannel:
+    # Looks like an ADC to a Thermistor, but returns the filtered burst sum
+    def __init__(self, sampler, index):
+        self._sampler = sampler
+        self._index = index
+        self.frac_bits = sampler.frac_bits + FILTER_BITS
+
+    def read(self):
+        return self._sampler.filtered[self._index]
+
+    @property
+    def time_constant(self):
+        return self._sampler.time_constants[self._index]
+
+    @time_constant.setter
+    def time_constant(self, tc):
+        self._sampler.set_time_constant(self._index, tc)
+
+# Helpers for formatting text into a preallocated buffer without
+# allocating. Each returns the offset following what it wrote.
+def put_bytes(buf, n, b):
+    e = n + len(b)
+    buf[n:e] = b
+    return e
+
+def put_int(buf, n, v):
+    if v < 0:
+        buf[n] = 45
+        n += 1
+        v = -v
+    # Count the digits, then fill them in from the right
+    e = n + 1
+    d = v
+    while d >= 10:
+        d //= 10
+        e += 1
+    i = e
+    while True:
+        i -= 1
+        buf[i] = 48 + v % 10
+        v //= 10
+        if not v:
+            break
+    return e
+
+def put_tenths(buf, n, x):
+    # Write a number rounded to one decimal place
+    v = int(x * 10 + (0.5 if x >= 0 else -0.5))
+    if v < 0:
+        buf[n] = 45
+        n += 1
+        v = -v
+    n = put_int(buf, n, v // 10)
+    buf[n] = 46
+    buf[n+1] = 48 + v % 10
+    return n + 2
+
+def put_centi(buf, n, v):
+    # Write an integer number of hundredths as a decimal
+    if v < 0:
+        buf[n] = 45
+        n += 1
+        v = -v
+    n = put_int(buf, n, v // 100)
+    v %= 100
+    buf[n] = 46
+    buf[n+1] = 48 + v // 10
+    buf[n+2] = 48 + v % 10
+    return n + 3
+
+def day_of_week(y, m, d):
+    # Monday is 0
+    t = (0, 3, 2, 5, 0, 3, 5, 1, 4, 6, 2, 4)
+    if m < 3:
+        y -= 1
+    return (y + y//4 - y//100 + y//400 + t[m-1] + d + 6) % 7
+
+def days_in_month(y, m):
+    if m == 2:
+        return 29 if (y % 4 == 0 and y % 100 != 0) or y % 400 == 0 else 28
+    return 30 if m in (4, 6, 9, 11) else 31
+
 def calibrate_termistor(t0, r0, t1, r1):
     # Return constants for termistor based on two reference readings
     # Input temperatures are in Celsius
@@ -72,38 +407,52 @@ class Thermistor:
         self._ref_R = ref_R
         self._beta = beta
         self._r_inf = r_inf
+        self._table = temperature_table(ref_R, beta, r_inf)
+        # Sampled channels have extra bits of resolution and are filtered
+        # by the sampler, so reading never touches the hardware
+        self._frac_bits = getattr(adc, "frac_bits", 0)
+        self._sampled = hasattr(adc, "time_constant")
+        self._time_constant = DEFAULT_TIME_CONSTANT
         self._filter = self._raw_T()
         self._filter_time = time.ticks_ms()
-        
-    def _RtoT(self, r):
-        # Convert resistance into temperature in Kelvin
-        return self._beta/math.log(r/self._r_inf)
 
-    def _read_R(self):
-        # Read ADC and compute termistor resistance
-        v = self._adc.read() / 4096.0
-        return v*self._ref_R/(1-v) if v else (self._ref_R/10000.0)
+    def _raw_T(self):
+        # Return the temperature in Celsius, unfiltered unless sampled
+        return table_lookup(self._table, self._adc.read(), self._frac_bits) / 100
 
-    def _raw_T(self): 
-        # Return unfiltered temperature in Celsius
-        r = self._read_R()
-        return self._RtoT(r) - zeroCK
+    @property
+    def time_constant(self):
+        """Time constant of the low-pass filter in seconds"""
+        return self._adc.time_constant if self._sampled else self._time_constant
+
+    @time_constant.setter
+    def time_constant(self, tc):
+        if self._sampled:
+            self._adc.time_constant = tc
+        else:
+            self._time_constant = tc
 
     def read_T(self):
         """Read filtered temperature in Celsius"""
-        # Read the temerature low-pass filtered with a time constant of 1000 milisecond
-        tc = 1000
+        if self._sampled:
+            return self._raw_T()
+        # Without a sampler the filter runs whenever the temperature is read
         raw_t = self._raw_T()
         t = time.ticks_ms()
-        e = math.exp(time.ticks_diff(self._filter_time, t)/tc)
+        tc = self._time_constant * 1000
+        e = math.exp(time.ticks_diff(self._filter_time, t)/tc) if tc > 0 else 0
         self._filter = (e * self._filter) + ((1-e) * raw_t)
         self._filter_time = t
         return self._filter
-    
+
 
 class Thermostat:
-    def __init__(self, t, r, index, set_point=20.0, dead_zone=1.0, override=None, adjust=0.0, **extra_args):
+    def __init__(self, t, r, index, set_point=20.0, dead_zone=1.0, override=None, adjust=0.0,
+                 time_constant=DEFAULT_TIME_CONSTANT, schedule=(),
+                 report=(DEFAULT_REPORT_DEADBAND, DEFAULT_REPORT_MIN, DEFAULT_REPORT_MAX, DEFAULT_REPORT_EDGE),
+                 **extra_args):
         self._t = t
+        self._t.time_constant = time_constant
         self._r = r
         self._r.value(0)
         self.index = index
@@ -111,6 +460,11 @@ class Thermostat:
         self._dead = dead_zone/2
         self._override = None if (override == -1) else override
         self.adjust = adjust
+        # (days mask, minute of day, set point) entries, in time of day order
+        self.schedule = list(schedule)
+        self.report_deadband, self.report_min, self.report_max, self.report_edge = report
+        # The temperature read by the last update
+        self.last_temp = 0.0
         if extra_args:
             debug("Extra args provided: {}".format(extra_args))
         
@@ -120,7 +474,14 @@ class Thermostat:
         return self._t.read_T() + self.adjust
 
     def check(self):
+        self.update()
+        return (self.last_temp, self._r.value())
+
+    def update(self):
+        # Switch the output as the temperature calls for, like check() but
+        # without building a result, for the control loop
         t = self.temp
+        self.last_temp = t
         if self._override != None:
             self._r.value(self._override)
         else:
@@ -130,12 +491,19 @@ class Thermostat:
             else:
                 if t < self._set - self._dead:
                     self._r.value(1)
-        return (t, self._r.value())
 
     @property
     def set_point(self):
         return self._set
 
+    @property
+    def time_constant(self):
+        return self._t.time_constant
+
+    @time_constant.setter
+    def time_constant(self, tc):
+        self._t.time_constant = tc
+
     @set_point.setter
     def set_point(self, set_temp):
         self._set = set_temp
@@ -157,8 +525,50 @@ class Thermostat:
         self.check()
         return self._r.value()
 
-    def state_string(self):
-        return "CHAN={} T={:.1f} SET={:.1f} OUT={} ADJ={:.1f} OVERRIDE={}\r\n".format(self.index, self.temp, self.set_point, self.state, self.adjust, self.override)
+    @property
+    def output(self):
+        # The relay state, without running the thermostat
+        return self._r.value()
+
+    def apply_schedule(self, prev, now):
+        # Apply the latest schedule entry that came due after minute prev of
+        # the week, up to minute now, or the entry in force if prev is -1
+        window = MINUTES_PER_WEEK if prev < 0 else (now - prev) % MINUTES_PER_WEEK
+        best = window
+        set_point = None
+        for mask, minute, sp in self.schedule:
+            for d in range(7):
+                if mask & (1 << d):
+                    back = (now - d * 1440 - minute) % MINUTES_PER_WEEK
+                    if back < best:
+                        best = back
+                        set_point = sp
+        if set_point is not None:
+            self.set_point = set_point
+
+    def format_state(self, buf, n):
+        # Write the state line CHAN=<n> T=<t> SET=<t> OUT=<n> ADJ=<t> OVERRIDE=<n>
+        n = put_bytes(buf, n, b"CHAN=")
+        n = put_int(buf, n, self.index)
+        n = put_bytes(buf, n, b" T=")
+        n = put_tenths(buf, n, self.temp)
+        n = put_bytes(buf, n, b" SET=")
+        n = put_tenths(buf, n, self._set)
+        n = put_bytes(buf, n, b" OUT=")
+        n = put_int(buf, n, self.state)
+        n = put_bytes(buf, n, b" ADJ=")
+        n = put_tenths(buf, n, self.adjust)
+        n = put_bytes(buf, n, b" OVERRIDE=")
+        o = self._override
+        n = put_bytes(buf, n, b"None") if o is None else put_int(buf, n, int(o))
+        return put_bytes(buf, n, b"\r\n")
+
+    def pack_state(self, buf, offset):
+        o = self._override
+        struct.pack_into(STATE_RECORD, buf, offset, self.index, int(round(self.temp * 100)),
+                         int(round(self._set * 100)), self.state, int(round(self.adjust * 100)),
+                         -1 if o is None else int(o))
+        return offset + STATE_RECORD_SIZE
 
     @property
     def config(self):
@@ -166,7 +576,10 @@ class Thermostat:
             "set_point":self._set,
             "dead_zone":self._dead*2,
             "override": -1 if (self._override is None) else (1 if self._override else 0),
-            "adjust": self.adjust
+            "adjust": self.adjust,
+            "time_constant": self._t.time_constant,
+            "schedule": self.schedule,
+            "report": (self.report_deadband, self.report_min, self.report_max, self.report_edge)
         }
 
     @config.setter
@@ -175,13 +588,109 @@ class Thermostat:
         self._dead = config["dead_zone"]/2
         self._override = None if config["override"] == -1 else config["override"]
         self.adjust = config["adjust"]
+        self._t.time_constant = config.get("time_constant", DEFAULT_TIME_CONSTANT)
+        self.schedule = list(config.get("schedule", ()))
+        self.report_deadband, self.report_min, self.report_max, self.report_edge = config.get(
+            "report", (DEFAULT_REPORT_DEADBAND, DEFAULT_REPORT_MIN, DEFAULT_REPORT_MAX, DEFAULT_REPORT_EDGE))
         self.check()
-        k = set(config.keys()) - {"set_point", "dead_zone", "override", "adjust"}
+        k = set(config.keys()) - {"set_point", "dead_zone", "override", "adjust", "time_constant", "schedule",
+                                  "report"}
         if k:
             debug("Extra keys in config being set: {}".format(k))
         
-mon_countdown = 0
-mon_report = False
+class History:
+    """A ring buffer of periodic samples of the temperature and output of every channel"""
+    def __init__(self, period=DEFAULT_HISTORY_PERIOD, length=DEFAULT_HISTORY_LENGTH):
+        self.period = period
+        self.length = length
+        self.temps = array.array("h", (0 for i in range(length * HARDWARE_CHANNELS)))
+        self.outs = bytearray(length)
+        self.count = 0
+        self._next = 0
+        self.last_time = time.ticks_ms()
+
+    def clear(self):
+        self.count = 0
+        self._next = 0
+
+    def add(self, therms):
+        i = self._next
+        base = i * HARDWARE_CHANNELS
+        mask = 0
+        for c in range(HARDWARE_CHANNELS):
+            t = therms[c]
+            v = t.temp * 100
+            self.temps[base + c] = int(min(max(v + (0.5 if v >= 0 else -0.5), -32767), 32767))
+            if t.output:
+                mask |= 1 << c
+        self.outs[i] = mask
+        self._next = (i + 1) % self.length
+        if self.count < self.length:
+            self.count += 1
+        self.last_time = time.ticks_ms()
+
+    def age(self):
+        # Seconds since the newest sample was taken
+        return time.ticks_diff(time.ticks_ms(), self.last_time) // 1000
+
+    def index(self, k):
+        # Position in the ring of the k'th oldest sample
+        return (self._next - self.count + k) % self.length
+
+    def pack(self, buf, n, k):
+        # Pack the k'th oldest sample into a buffer as a HISTORY record
+        i = self.index(k)
+        buf[n] = self.outs[i]
+        base = i * HARDWARE_CHANNELS
+        for c in range(HARDWARE_CHANNELS):
+            v = self.temps[base + c]
+            buf[n + 1 + 2*c] = v & 0xff
+            buf[n + 2 + 2*c] = (v >> 8) & 0xff
+        return n + HISTORY_RECORD_SIZE
+
+    def format(self, buf, n, k):
+        # Write the k'th oldest sample as <index> <outputs> <temperature>...
+        i = self.index(k)
+        n = put_int(buf, n, k)
+        buf[n] = 32
+        n = put_int(buf, n + 1, self.outs[i])
+        base = i * HARDWARE_CHANNELS
+        for c in range(HARDWARE_CHANNELS):
+            buf[n] = 32
+            n = put_centi(buf, n + 1, self.temps[base + c])
+        return n
+
+class LoopStats:
+    """Recent samples of the time taken by each part of the firmware's work
+
+    The samples are kept in fixed arrays, so recording them allocates
+    nothing. Percentiles are only worked out when they are asked for."""
+    NAMES = ("LOOP", "PERIOD", "CHECK", "IO", "GC")
+
+    def __init__(self, length=LOOPSTATS_SAMPLES):
+        self.length = length
+        self.samples = [array.array("I", (0 for i in range(length))) for n in self.NAMES]
+        self.counts = array.array("I", (0 for n in self.NAMES))
+        self.clear()
+
+    def clear(self):
+        for k in range(len(self.NAMES)):
+            self.counts[k] = 0
+        self.mem_low = gc.mem_free()
+        self.wdt_max = 0
+
+    def add(self, k, us):
+        n = self.counts[k]
+        self.samples[k][n % self.length] = us
+        self.counts[k] = n + 1
+
+    def percentiles(self, k):
+        # The median, 90th and 99th percentiles and the maximum of the samples kept
+        v = sorted(self.samples[k][:min(self.counts[k], self.length)])
+        if not v:
+            return 0, 0, 0, 0
+        n = len(v)
+        return v[n // 2], v[(n * 90) // 100], v[(n * 99) // 100], v[-1]
 
 class ActivityLED:
     def __init__(self, led_number=1, timer_number=1):
@@ -199,117 +708,469 @@ class ActivityLED:
         self._timer.deinit()
 
 class CommandLine:       
-    def __init__(self, serial_port, n_chan, t_list, monitor_period=30, exit_allowed=False, wdt_timeout=None):
+    def __init__(self, serial_port, n_chan, t_list, monitor_period=30, exit_allowed=False, wdt_timeout=None, history=None):
         debug("Constructing command line object")
+        self.history = history
+        # The length to use from the next start, which SAVECONFIG saves
+        self.history_length = history.length if history else 0
         self.port = serial_port
         self.n_chan = n_chan
         self.t_list = t_list
         self.monitor_period = monitor_period
         self.exit_allowed = exit_allowed
         self.wdt_to = wdt_timeout
-        self.mon_report = False
-        self.mon_countdown = monitor_period
-        self.mon_timer = pyb.Timer(5)
-
-        self.mon_timer.init(freq=1)
-        self.mon_timer.callback(self._mon_callback)
+        self._mon_due = time.time() + monitor_period
         self.async_state = False
-
-        self.EXIT_flag = False
+        self.binary = False
+        self._frame = bytearray(FRAME_HEADER_SIZE + FRAME_PAYLOAD_MAX + 2)
+        self._frame_mv = memoryview(self._frame)
+        self._out = bytearray(OUTPUT_BUFFER)
+        self._out_mv = memoryview(self._out)
+        # Input is read into a fixed buffer, gathered into a line buffer and
+        # split into tokens in place
+        self._read = bytearray(INPUT_BUFFER)
+        self._in = bytearray(INPUT_BUFFER)
+        self._in_mv = memoryview(self._in)
+        self._in_n = 0
+        self._tok_start = array.array("H", (0 for i in range(MAX_TOKENS)))
+        self._tok_end = array.array("H", (0 for i in range(MAX_TOKENS)))
+        # The tag of the command being processed, echoed in its responses,
+        # and the number of responses sent for it
+        self._tag = 0
+        self._sent = 0
+        self.gc_count = 0
+        self.gc_total = 0
+        self.gc_max = 0
+        self._last_gc = time.ticks_ms()
+        self.stats = LoopStats()
+        self._last_step = time.ticks_us()
+        self.rtc = pyb.RTC()
+        # The minute of the week up to which the schedules have been run,
+        # or -1 if they have not run since the clock was set, and the time
+        # at which they are next checked
+        self._sched_minute = -1
+        self._sched_due = 0
+
+        self._exit = None
+        self._checked_schedules = {}
+        self._checked_n_chan = n_chan
+        self._checked_saved = None
+        # Set by the control task and cleared when the watchdog is fed
+        self._alive = False
+        # The state of each channel when it was last reported by ASYNC,
+        # including the set point since the schedules change it, and when
+        self._previous_temp = [0.0] * HARDWARE_CHANNELS
+        self._previous_out = bytearray(HARDWARE_CHANNELS)
+        self._previous_set = [0.0] * HARDWARE_CHANNELS
+        self._reported_at = [0] * HARDWARE_CHANNELS
 
         self.pulse_LED = pyb.LED(2)
         self.activity = ActivityLED()
 
-    def _mon_callback(self, t):
-        self.mon_countdown -= 1
-        if self.mon_countdown == 0:
-            self.mon_report = True
+    def _send_frame(self, f_type, n, tag=0):
+        # The payload must already be in the frame buffer
+        f = self._frame
+        f[0] = FRAME_SYNC
+        f[1] = f_type
+        f[2] = tag & 0xff
+        f[3] = tag >> 8
+        f[4] = n & 0xff
+        f[5] = n >> 8
+        e = n + FRAME_HEADER_SIZE
+        c = sum(self._frame_mv[1:e])
+        f[e] = c & 0xff
+        f[e+1] = (c >> 8) & 0xff
+        self.port.write(self._frame_mv[:e+2])
+
+    def _send_text_frame(self, f_type, s):
+        b = s.encode("UTF8")
+        n = min(len(b), FRAME_PAYLOAD_MAX)
+        self._frame[FRAME_HEADER_SIZE:n+FRAME_HEADER_SIZE] = b[:n]
+        self._send_frame(f_type, n, self._tag)
+
+    def _put_tag(self, n, tag):
+        # Write the #<tag> prefix of a response to a tagged command
+        if tag:
+            self._out[n] = 35
+            n = put_int(self._out, n + 1, tag)
+            self._out[n] = 32
+            n += 1
+        return n
+
+    def _write_line(self, prefix, s):
+        n = self._put_tag(0, self._tag)
+        if n:
+            self.port.write(self._out_mv[:n])
+        if prefix:
+            self.port.write(prefix)
+        self.port.write(s)
+        self.port.write(b"\r\n")
+
+    def _reply(self, s):
+        # Send a single line response to a command
+        self._sent += 1
+        if self.binary:
+            self._send_text_frame(FRAME_RESPONSE, s)
+        else:
+            self._write_line(None, s)
+
+    def _error(self, s):
+        self._sent += 1
+        if self.binary:
+            self._send_text_frame(FRAME_ERROR, "ERR " + s)
+        else:
+            self._write_line(b"ERR ", s)
+
+    def _send_states(self, prefix, f_type, therms, tag=0, mask=-1):
+        # Send the state of a set of thermostats, either as one line per
+        # thermostat or as a single frame holding all of them. Bits clear in
+        # the mask skip the thermostat at that position in the list.
+        if self.binary:
+            n = 0
+            for i in range(len(therms)):
+                if (mask >> i) & 1:
+                    n = therms[i].pack_state(self._frame, n + FRAME_HEADER_SIZE) - FRAME_HEADER_SIZE
+            self._send_frame(f_type, n, tag)
+            self._sent += 1
+        else:
+            buf = self._out
+            n = 0
+            for i in range(len(therms)):
+                if not (mask >> i) & 1:
+                    continue
+                t = therms[i]
+                self._sent += 1
+                n = self._put_tag(n, tag)
+                n = put_bytes(buf, n, prefix)
+                n = t.format_state(buf, n)
+            self.port.write(self._out_mv[:n])
 
     def command_loop(self):
+        # Control-C arrives as ordinary input, rather than interrupting
+        # whichever task happens to be running
+        micropython.kbd_intr(-1)
+        try:
+            asyncio.run(self._main())
+        finally:
+            micropython.kbd_intr(3)
+
+    async def _main(self):
+        self._exit = asyncio.Event()
+        tasks = [asyncio.create_task(self._input_task()),
+                 asyncio.create_task(self._control_task()),
+                 asyncio.create_task(self._monitor_task())]
         if self.wdt_to:
-            wdt = machine.WDT(timeout = int(self.wdt_to*1000))
-        else:
-            wdt = None
-    
-        serial_port = self.port
-        cmd_line = ""
-        previous_state = [(0,0)] * HARDWARE_CHANNELS
-        last_async = time.time()
-        
+            tasks.append(asyncio.create_task(self._watchdog_task()))
+        if self.history:
+            tasks.append(asyncio.create_task(self._history_task()))
+        await self._exit.wait()
+        for t in tasks:
+            t.cancel()
+
+    async def _input_task(self):
+        reader = asyncio.StreamReader(self.port)
+        buf = self._in
+        # Always reading into the whole of one buffer means no memoryview
+        # has to be made for each read
+        rd = self._read
         while True:
-            # Clean up memory
-            gc.collect()
-            # Feed the (watch)dog
-            if wdt:
-                wdt.feed()
-            # Check if we are marked to quit
-            if self.EXIT_flag:
-                break
-            # Sleep a little
-            time.sleep(0.1)
-            # Blink the green light at 1Hz
-            self.pulse_LED.on() if (time.time() & 1) else self.pulse_LED.off()
-
-            # Check all the thermostats and see what has changed
-            changes = set()
-            for i, t in enumerate(self.t_list):
-                if i < self.n_chan:
-                    s = t.check()
-                    p = previous_state[i]
-                    if s[1] != p[1] or abs(s[0]-p[0]) > 0.1:
-                        changes.add(i)
-                        previous_state[i] = s
+            got = await reader.readinto(rd)
+            if not got:
+                continue
+            self.activity.activity(0.1)
+            t0 = time.ticks_us()
+            n = self._in_n
+            for i in range(got):
+                c = rd[i]
+                if c == 13:
+                    self._process_line(0, n)
+                    n = 0
+                    continue
+                if n == INPUT_BUFFER:
+                    # There is no line ending in a full buffer, so drop it
+                    n = 0
+                    self._error("command line too long")
+                if c == 3:
+                    c = 32
+                    self._reply("INTERRUPT: Use EXIT command rather than control-C")
+                buf[n] = c
+                n += 1
+            # Keep any partial line for the next read
+            self._in_n = n
+            self.stats.add(STAT_IO, time.ticks_diff(time.ticks_us(), t0))
+
+    def _end(self):
+        # Mark the end of the responses to a tagged command, giving the
+        # number of responses so the host can tell if any were lost
+        if self.binary:
+            f = self._frame
+            f[FRAME_HEADER_SIZE] = self._sent & 0xff
+            f[FRAME_HEADER_SIZE+1] = self._sent >> 8
+            self._send_frame(FRAME_END, 2, self._tag)
+        else:
+            n = self._put_tag(0, self._tag)
+            n = put_bytes(self._out, n, b"END ")
+            n = put_int(self._out, n, self._sent)
+            n = put_bytes(self._out, n, b"\r\n")
+            self.port.write(self._out_mv[:n])
+
+    def _process_line(self, start, end):
+        self._sent = 0
+        try:
+            n = self._tokenize(start, end)
+            if not n:
+                # Respond to empty lines, so that the user knows we're alive
+                self._reply("OK")
+                return
+            # A command may be preceded by a tag of the form #<n>, which is
+            # echoed in all of the responses to the command
+            first = 0
+            if self._in[self._tok_start[0]] == 35:
+                tag = self._parse_uint(self._tok_start[0] + 1, self._tok_end[0])
+                if tag < 1 or tag > 65535:
+                    msg = "command tag must be a number from 1 to 65535"
+                    if self.binary:
+                        # The tag can't be put in a frame, so the error is untagged
+                        self._error(msg)
+                        return
+                    # Echo the tag as sent, so that the sender is not left
+                    # waiting for a response to it
+                    t = self._in_mv[self._tok_start[0]:self._tok_end[0]]
+                    self._write_line(t, " ERR " + msg)
+                    self._write_line(t, " END 1")
+                    return
+                self._tag = tag
+                if n == 1:
+                    self._reply("OK")
+                    return
+                first = 1
+            if n > MAX_TOKENS:
+                self._error("command line has more than {} tokens".format(MAX_TOKENS))
+                return
+            # Commands are separated by ';'. If the first is preceded by '!'
+            # then none are run unless they are all valid.
+            s = self._tok_start[first]
+            if self._in[s] == 33:
+                if self._tok_end[first] - s == 1:
+                    first += 1
                 else:
-                    # Keep reading the temperature on unused channels, to keep the filter going 
-                    _ = t.temp
-                    
-            # If ASYNC is enabled print out what changed
-            if self.async_state and changes and time.time() != last_async:
-                last_async = time.time()
-                while changes:
-                    i = changes.pop()
-                    self.activity.activity(0.05)
-                    serial_port.write("*ASYNC ")
-                    serial_port.write(self.t_list[i].state_string())
-
-            # debug("Monitor: countdown={}, report={}, period={}".format(mon_countdown, mon_report, monitor_period))
-            if self.mon_report:
-                # Clear the report flag
-                self.mon_report = False
-                # If monitoring is on then reset the countdown
-                if self.monitor_period:
-                    self.mon_countdown = (self.mon_countdown % self.monitor_period) if self.mon_countdown else self.monitor_period
-                for i in range(self.n_chan):
-                    serial_port.write("*MONITOR ")
-                    serial_port.write(self.t_list[i].state_string())
-
-            # Process input
-            while True:
-                try:
-                    if serial_port.any():
-                        cmd_line += str(serial_port.read(), "UTF8")
-                        self.activity.activity(0.1)
-                except KeyboardInterrupt as k:
-                    serial_port.write("INTERRUPT: Use EXIT command rather than control-C\r\n")
-
-                # If we have exhausted input and there is no line break then drop out of the input loop
-                if "\r" not in cmd_line:
-                    break
-
-                # Extract the first line
-                l, cmd_line = cmd_line.split("\r", 1)    
-                l = l.strip()
-
-                # Process the command
-                if not l:
-                    # Respond to empty lines, so that the user knows we're alive
-                    serial_port.write("OK\r\n")
+                    self._tok_start[first] = s + 1
+                i = first
+                valid = True
+                # Schedules and channel count as changed by the commands
+                # checked so far
+                self._checked_schedules = {}
+                self._checked_n_chan = self.n_chan
+                self._checked_saved = None
+                while i < n:
+                    e = self._command_end(i, n)
+                    if e > i and self._check_command(i, e, True) is None:
+                        valid = False
+                    i = e + 1
+                if not valid:
+                    self._error("no commands run")
+                    return
+            i = first
+            while i < n:
+                e = self._command_end(i, n)
+                if e > i:
+                    self._process_command(i, e)
+                i = e + 1
+        except Exception as e:
+            self._error("EXCEPTION trying to process command line {}: {}".format(e.__class__.__name__, e))
+        finally:
+            if self._tag:
+                self._end()
+            self._tag = 0
+
+    def _tokenize(self, start, end):
+        # Record where each space separated token in the line starts and
+        # ends, returning the number of tokens
+        buf = self._in
+        n = 0
+        i = start
+        while i < end:
+            if buf[i] <= 32:
+                i += 1
+                continue
+            s = i
+            if buf[i] == 59:
+                # Command separators are tokens, even without spaces around them
+                i += 1
+            else:
+                while i < end and buf[i] > 32 and buf[i] != 59:
+                    i += 1
+            if n < MAX_TOKENS:
+                self._tok_start[n] = s
+                self._tok_end[n] = i
+            n += 1
+        return n
+
+    def _command_end(self, i, n):
+        # Return the index of the ';' token ending the command starting at
+        # token i, or n if it is the last command on the line
+        while i < n:
+            if self._in[self._tok_start[i]] == 59:
+                return i
+            i += 1
+        return n
+
+    def _token_str(self, i):
+        return str(self._in_mv[self._tok_start[i]:self._tok_end[i]], "UTF8")
+
+    def _parse_uint(self, s, e):
+        # Return the value of a run of decimal digits, or -1
+        if s >= e:
+            return -1
+        buf = self._in
+        v = 0
+        for i in range(s, e):
+            c = buf[i] - 48
+            if c < 0 or c > 9:
+                return -1
+            v = v * 10 + c
+        return v
+
+    def _lookup_verb(self, i):
+        # Match a token against the command names, ignoring case
+        buf = self._in
+        s = self._tok_start[i]
+        e = self._tok_end[i]
+        for j in range(s, e):
+            if 97 <= buf[j] <= 122:
+                buf[j] -= 32
+        for c in self._command_names:
+            name = c[0]
+            if len(name) == e - s:
+                for j in range(e - s):
+                    if buf[s + j] != name[j]:
+                        break
                 else:
-                    try:
-                        self._process_command(l)
-                    except Exception as e:
-                        self.port.write("ERR EXCEPTION trying to process command line {}: {}\r\n".format(e.__class__.__name__, e))
-                        # sys.print_exception(e)                        
+                    return c
+        return None
+
+    async def _control_task(self):
+        while True:
+            self._control_step()
+            await asyncio.sleep_ms(CONTROL_PERIOD)
+
+    def _control_step(self):
+        stats = self.stats
+        t0 = time.ticks_us()
+        stats.add(STAT_PERIOD, time.ticks_diff(t0, self._last_step))
+        self._last_step = t0
+        # Clean up memory every so often, or when it is running low
+        free = gc.mem_free()
+        if free < stats.mem_low:
+            stats.mem_low = free
+        if free < GC_MIN_FREE or time.ticks_diff(time.ticks_ms(), self._last_gc) >= GC_INTERVAL:
+            self._collect()
+        self._alive = True
+        # Blink the green light at 1Hz
+        now = time.time()
+        self.pulse_LED.on() if (now & 1) else self.pulse_LED.off()
+        if now >= self._sched_due:
+            self._schedule_step()
+
+        # Check all the thermostats and see which are due to be reported,
+        # as a bit mask so that nothing is allocated
+        changes = 0
+        ms = time.ticks_ms()
+        t1 = time.ticks_us()
+        t_list = self.t_list
+        for i in range(HARDWARE_CHANNELS):
+            t = t_list[i]
+            if i < self.n_chan:
+                t.update()
+                if self.async_state and self._report_due(i, t, ms):
+                    changes |= 1 << i
+            else:
+                # Keep reading the temperature on unused channels, to keep the filter going
+                _ = t.temp
+        stats.add(STAT_CHECK, time.ticks_diff(time.ticks_us(), t1))
+
+        # If ASYNC is enabled print out what changed
+        if changes:
+            self.activity.activity(0.05)
+            self._send_states(b"*ASYNC ", FRAME_ASYNC, t_list, mask=changes)
+        stats.add(STAT_LOOP, time.ticks_diff(time.ticks_us(), t0))
+
+    def _report_due(self, i, t, ms):
+        # Decide by the channel's reporting policy whether its state after
+        # the last update should be reported, and if so record it as
+        # reported. Output and set point changes are always reported at once.
+        temp = t.last_temp
+        out = t.output
+        age = time.ticks_diff(ms, self._reported_at[i])
+        if not (out != self._previous_out[i] or t.set_point != self._previous_set[i] or
+                (t.report_max and age >= t.report_max * 1000) or
+                (not t.report_edge and age >= t.report_min * 1000 and abs(temp - self._previous_temp[i]) > t.report_deadband)):
+            return False
+        self._previous_temp[i] = temp
+        self._previous_out[i] = out
+        self._previous_set[i] = t.set_point
+        self._reported_at[i] = ms
+        return True
+
+    def _clock_minute(self):
+        # Return the minute of the week, from 0 at midnight on Monday, and
+        # the seconds into the minute, or -1 if the clock has not been set
+        y, mo, d, wd, h, mi, s, _ = self.rtc.datetime()
+        if y < RTC_MIN_YEAR:
+            return -1, s
+        return (wd - 1) * 1440 + h * 60 + mi, s
+
+    def _schedule_step(self):
+        now, s = self._clock_minute()
+        self._sched_due = time.time() + 60 - s
+        prev = self._sched_minute
+        if now < 0 or now == prev:
+            return
+        self._sched_minute = now
+        # If the clock went back, entries that already ran are not run again
+        if prev >= 0 and (now - prev) % MINUTES_PER_WEEK > MINUTES_PER_WEEK // 2:
+            return
+        for t in self.t_list[:self.n_chan]:
+            t.apply_schedule(prev, now)
+
+    def _collect(self):
+        t0 = time.ticks_us()
+        gc.collect()
+        dt = time.ticks_diff(time.ticks_us(), t0)
+        self._last_gc = time.ticks_ms()
+        self.gc_count += 1
+        self.gc_total += dt
+        if dt > self.gc_max:
+            self.gc_max = dt
+        self.stats.add(STAT_GC, dt)
+
+    async def _monitor_task(self):
+        while True:
+            await asyncio.sleep(1)
+            if self.monitor_period and time.time() >= self._mon_due:
+                self._mon_due = time.time() + self.monitor_period
+                self._send_states(b"*MONITOR ", FRAME_MONITOR, self.t_list[:self.n_chan])
+
+    async def _history_task(self):
+        h = self.history
+        while True:
+            await asyncio.sleep(1)
+            if h.period and time.ticks_diff(time.ticks_ms(), h.last_time) >= h.period * 1000:
+                h.add(self.t_list)
+
+    async def _watchdog_task(self):
+        wdt = machine.WDT(timeout = int(self.wdt_to*1000))
+        last_feed = time.ticks_ms()
+        while True:
+            # Only feed the (watch)dog while the control task is still running
+            if self._alive:
+                self._alive = False
+                wdt.feed()
+                now = time.ticks_ms()
+                if time.ticks_diff(now, last_feed) > self.stats.wdt_max:
+                    self.stats.wdt_max = time.ticks_diff(now, last_feed)
+                last_feed = now
+            await asyncio.sleep_ms(WDT_FEED_PERIOD)
 
     @staticmethod
     def _parse_tristate_arg(arg):
@@ -322,9 +1183,37 @@ class CommandLine:
                 "0": 0 }
         arg = arg.upper()
         if arg not in opts:
-            self.port.write("ERR invalid argument {}\r\n".format(arg))
+            raise ValueError("invalid argument {}".format(arg))
         return opts[arg]
 
+    @staticmethod
+    def _parse_schedule_entry(arg):
+        # Entries are <days>@<HH:MM>=<set point>, with the days as digits
+        # from 1 for Monday to 7 for Sunday
+        days, _, rest = arg.partition("@")
+        tod, _, sp = rest.partition("=")
+        h, _, mi = tod.partition(":")
+        mask = 0
+        for c in days:
+            d = ord(c) - 49
+            if d < 0 or d > 6:
+                raise ValueError("invalid days in schedule entry {}".format(arg))
+            mask |= 1 << d
+        h = int(h)
+        mi = int(mi)
+        sp = float(sp)
+        if not mask or h < 0 or h > 23 or mi < 0 or mi > 59:
+            raise ValueError("invalid schedule entry {}".format(arg))
+        if sp < 5 or sp > 40:
+            raise ValueError("Temp must be between 5 and 40 C")
+        return (mask, h * 60 + mi, sp)
+
+    @staticmethod
+    def _format_schedule_entry(e):
+        mask, minute, sp = e
+        days = "".join(str(d + 1) for d in range(7) if mask & (1 << d))
+        return "{}@{:02d}:{:02d}={}".format(days, minute // 60, minute % 60, sp)
+
     # Each command is represented by a dictionary entry:
     #   <command name> : ( <needs thermostat index>, <min arg count>, <max arg count>)
     _command_table = {
@@ -343,93 +1232,181 @@ class CommandLine:
         "ID":         (False, 0, 0, "Print the board ID"),
         "ASYNC":      (False, 1, 1, "Enable or disable asynchronous state change messages"),
         "NCHAN":      (False, 0, 1, "Set the number of channels in operation"),
+        "PROTO":      (False, 0, 1, "Select the TEXT or BIN response protocol"),
+        "FILTER":     (True,  0, 1, "Set the time constant of the channel temperature filter"),
+        "HISTORY":    (False, 0, 2, "Print the sample history, or PERIOD or LENGTH to show or set the sample period or count"),
+        "GCSTATS":    (False, 0, 1, "Print garbage collection statistics, RESET to clear them"),
+        "LOOPSTATS":  (False, 0, 1, "Print loop timing percentiles, RESET to clear them"),
+        "RTC":        (False, 0, 2, "Print or set the local date and time, as YYYY-MM-DD HH:MM:SS"),
+        "REPORT":     (True,  0, 4, "Print or set the channel's ASYNC reporting policy"),
+        "SCHEDULE":   (True,  0, MAX_TOKENS, "Print or set the channel's weekly schedule, ADD to extend it or NONE to clear it"),
     }
 
-    def _process_command(self, l):
-        verb, *args = l.split()
-        verb = verb.upper()
-        debug("verb={}, args={}\r\n".format(verb, args))
-        if verb not in self._command_table:
-            self.port.write("ERR unknown command {}\r\n".format(verb))
-            return
+    # Command names as bytes for matching against the input, with the
+    # names of the methods that handle each and that check its arguments
+    _command_names = [(k.encode(), k, "_do_" + k.lower(), "_check_" + k.lower()) for k in _command_table]
+
+    # Commands which are passed the list of selected thermostats in one call
+    _list_commands = {"STATE"}
+
+    def _check_command(self, first, n, validate=False):
+        # The tokens from first up to n are the verb and its arguments.
+        # Returns the verb, handler name, selected thermostats and index of
+        # the first argument, or sends an error and returns None. With
+        # validate set the argument values are checked too, so that the
+        # command will not fail part way through.
+        c = self._lookup_verb(first)
+        if c is None:
+            self._error("unknown command {}".format(self._token_str(first)))
+            return None
+        _, verb, fn_name, check_name = c
+        tl = None
+        n_chan = self._checked_n_chan if validate else self.n_chan
 
         c_therm, c_min, c_max, c_help = self._command_table[verb]
-        n_args = len(args)
+        a = first + 1
+        n_args = n - a
         if c_therm:
             if n_args == 0:
-                self.port.write("ERR command {} requires thermostat number or *\r\n".format(verb))
-                return
+                self._error("command {} requires thermostat number or *".format(verb))
+                return None
             else:
-                therm_no = args.pop(0)
+                s = self._tok_start[a]
+                e = self._tok_end[a]
+                a += 1
                 n_args -= 1
-                if therm_no == "*":
-                    tl = range(self.n_chan)
+                if e - s == 1 and self._in[s] == 42:
+                    tl = range(n_chan)
                 else:
-                    try:
-                        i = int(therm_no)
-                    except ValueError:
-                        self.port.write("ERR can not parse channel number {}\r\n".format(therm_no))
-                        return
-                    if i < 1 or i > self.n_chan:
-                        self.port.write("ERR channel number must be in range 1 to {}\r\n".format(self.n_chan))
-                        return
+                    i = self._parse_uint(s, e)
+                    if i < 0:
+                        self._error("can not parse channel number {}".format(self._token_str(a-1)))
+                        return None
+                    if i < 1 or i > n_chan:
+                        self._error("channel number must be in range 1 to {}".format(n_chan))
+                        return None
                     tl = [i-1]
 
         if n_args < c_min:
-            self.port.write("ERR command {} requires at least {} arguments\r\n".format(verb, c_min))
-            return
+            self._error("command {} requires at least {} arguments".format(verb, c_min))
+            return None
         
         if n_args > c_max:
-            self.port.write("ERR command {} accepts at most {} arguments\r\n".format(verb, c_max))
+            self._error("command {} accepts at most {} arguments".format(verb, c_max))
+            return None
+
+        if validate and hasattr(self, check_name):
+            try:
+                getattr(self, check_name)(tl, *[self._token_str(i) for i in range(a, n)])
+            except Exception as e:
+                self._error("invalid arguments to {}: {}: {}".format(verb, e.__class__.__name__, e))
+                return None
+
+        return verb, fn_name, tl, a
+
+    def _process_command(self, first, n):
+        c = self._check_command(first, n)
+        if c is None:
             return
-        
-        c_fn = getattr(self, "_do_"+verb.lower())
+        verb, fn_name, tl, a = c
+        args = [self._token_str(i) for i in range(a, n)] if n > a else ()
+        c_fn = getattr(self, fn_name)
         try:
-            if c_therm:
+            if verb in self._list_commands:
+                c_fn([self.t_list[t] for t in tl], *args)
+            elif tl is not None:
                 for t in tl:
                     c_fn(self.t_list[t], *args)
             else:
                 c_fn(*args)
         except Exception as e:
-            self.port.write("ERR EXCEPTION while executing command {}: {}: {}\r\n".format(verb, e.__class__.__name__, e))
+            self._error("EXCEPTION while executing command {}: {}: {}".format(verb, e.__class__.__name__, e))
             sys.print_exception(e)
 
     def _do_version(self):
-        self.port.write("VERSION {}\r\n".format(__version__))
+        self._reply("VERSION {}".format(__version__))
+
+    # The _check_<verb> methods are passed the selected thermostats and the
+    # arguments, and raise an exception if the command would fail
+
+    @staticmethod
+    def _parse_nchan(count):
+        count = int(count)
+        if count < 1 or count > HARDWARE_CHANNELS:
+            raise ValueError("Channel count must be between 1 and {}".format(HARDWARE_CHANNELS))
+        return count
+
+    def _check_nchan(self, tl, *count):
+        if count:
+            self._checked_n_chan = self._parse_nchan(count[0])
 
     def _do_nchan(self, *count):
         if len(count) != 0:
-            count = int(count[0])
-            if count < 1 or count > HARDWARE_CHANNELS:
-                raise ValueError("Channel count must be between 1 and {}".format(HARDWARE_CHANNELS))
-            self.n_chan = count
-        self.port.write("NCHAN {} OK\r\n".format(self.n_chan))
+            self.n_chan = self._parse_nchan(count[0])
+        self._reply("NCHAN {} OK".format(self.n_chan))
 
     def _do_temp(self, therm):
-        self.port.write("TEMP {} {}\r\n".format(therm.index, therm.temp))
+        self._reply("TEMP {} {}".format(therm.index, therm.temp))
 
-    def _do_set(self, therm, temp):
+    @staticmethod
+    def _parse_set_point(temp):
         t = float(temp)
         if t < 5 or t > 40:
             raise ValueError("Temp must be between 5 and 40 C")
+        return t
+
+    def _check_set(self, tl, temp):
+        self._parse_set_point(temp)
+
+    def _do_set(self, therm, temp):
+        t = self._parse_set_point(temp)
         therm.set_point = t
-        self.port.write("SET {} {} OK\r\n".format(therm.index, t))
+        self._reply("SET {} {} OK".format(therm.index, t))
+
+    def _check_override(self, tl, state):
+        self._parse_tristate_arg(state)
 
     def _do_override(self, therm, state):
         therm.override = self._parse_tristate_arg(state)
-        self.port.write("OVERRIDE {} {} OK\r\n".format(therm.index, state.upper()))
+        self._reply("OVERRIDE {} {} OK".format(therm.index, state.upper()))
+
+    def _check_adjust(self, tl, offset):
+        if abs(float(offset)) > 5.0:
+            raise ValueError("ADJUST offset limited to +/- 5 celcius")
 
     def _do_adjust(self, therm, offset):
         offset = float(offset)
         if abs(offset) > 5.0:
-            self.port.write("ERR ADJUST offset limited to +/- 5 celcius, value {:.1f} out of range for thermostat {}\r\n".format(offset, therm.index))
+            self._error("ADJUST offset limited to +/- 5 celcius, value {:.1f} out of range for thermostat {}".format(offset, therm.index))
         else:
             therm.adjust = offset
-            self.port.write("ADJUST {} {:.1f} OK\r\n".format(therm.index, offset))
+            self._reply("ADJUST {} {:.1f} OK".format(therm.index, offset))
         
-    def _do_state(self, therm):
-        self.port.write("STATE ")
-        self.port.write(therm.state_string())
+    @staticmethod
+    def _parse_time_constant(tc):
+        tc = float(tc)
+        if tc < 0 or tc > MAX_TIME_CONSTANT:
+            raise ValueError("Time constant must be between 0 and {} seconds".format(MAX_TIME_CONSTANT))
+        return tc
+
+    def _check_filter(self, tl, *tc):
+        if tc:
+            self._parse_time_constant(tc[0])
+
+    def _do_filter(self, therm, *tc):
+        if len(tc):
+            tc = self._parse_time_constant(tc[0])
+            therm.time_constant = tc
+            self._reply("FILTER {} {} OK".format(therm.index, tc))
+        else:
+            self._reply("FILTER {} {}".format(therm.index, therm.time_constant))
+
+    def _do_state(self, therms):
+        self._send_states(b"STATE ", FRAME_STATE, therms, self._tag)
+
+    def _check_monitor(self, tl, *value):
+        if value and value[0].upper() != "OFF":
+            int(value[0])
 
     def _do_monitor(self, *value):
         if len(value):
@@ -438,47 +1415,82 @@ class CommandLine:
             else:
                 period = int(value[0])
                 self.monitor_period = period
-                self.mon_countdown = period
-            self.port.write("MONITOR {} OK\r\n".format(period))
+                self._mon_due = time.time() + period
+            self._reply("MONITOR {} OK".format(period))
         else:
-            self.port.write("MONITOR {}\r\n".format(self.monitor_period))
+            self._reply("MONITOR {}".format(self.monitor_period))
 
     def _do_saveconfig(self):
         conf = {"monitor": self.monitor_period,
                 "n_chan": self.n_chan,
+                "history_period": self.history.period if self.history else DEFAULT_HISTORY_PERIOD,
+                "history_length": self.history_length,
                 "therms": [t.config for t in self.t_list] }
-        with open("/flash/config.json", "w") as fh:
-            fh.write(json.dumps(conf))
-        self.port.write("SAVECONFIG OK\r\n")
+        save_config(conf)
+        self._reply("SAVECONFIG OK")
+
+    def _check_saveconfig(self, tl):
+        # Remember what would be saved, for a LOADCONFIG later in the line
+        checked = self._checked_schedules
+        self._checked_saved = (self._checked_n_chan,
+                               {i: checked.get(i, t.schedule) for i, t in enumerate(self.t_list)})
+
+    def _check_loadconfig(self, tl):
+        # Later commands on the line see the loaded channel count and schedules
+        if self._checked_saved:
+            n_chan, schedules = self._checked_saved
+        else:
+            conf = load_config()
+            n_chan = conf["n_chan"]
+            schedules = {i: list(c.get("schedule", ())) for i, c in enumerate(conf["therms"])}
+        self._checked_n_chan = n_chan
+        self._checked_schedules = dict(schedules)
 
     def _do_loadconfig(self):
         conf = load_config()
         self.monitor_period = conf["monitor"]
         self.n_chan = conf["n_chan"]
+        self.history_length = conf["history_length"]
         for c, t in zip(conf["therms"], self.t_list):
             t.config = c
-        self.port.write("LOADCONFIG OK\r\n")
+        if self.history and self.history.period != conf["history_period"]:
+            self.history.period = conf["history_period"]
+            self.history.clear()
+        # Put the loaded schedules into effect
+        self._sched_minute = -1
+        self._sched_due = 0
+        self._reply("LOADCONFIG OK")
+
+    def _check_exit(self, tl):
+        if not self.exit_allowed:
+            raise ValueError("EXIT disallowed")
 
     def _do_exit(self):
         if self.exit_allowed:
-            self.EXIT_flag = True
-            self.port.write("EXIT OK\r\n")
+            self._exit.set()
+            self._reply("EXIT OK")
         else:
-            self.port.write("ERR EXIT disallowed\r\n")
+            self._error("EXIT disallowed")
             
     def _do_reset(self, *arg):
         hard = (arg and arg[0].upper() == "HARD")
-        self.port.write("RESET OK\r\n")
+        self._reply("RESET OK")
+        # The board restarts without ending the response
+        self._tag = 0
         if hard:
             machine.reset()
         else:
             machine.soft_reset()
 
+    def _check_help(self, tl, cmd=None):
+        if cmd and cmd.upper() not in self._command_table:
+            raise ValueError("unknown command {}".format(cmd))
+
     def _do_help(self, cmd=None):
         if cmd:
             cmd = cmd.upper()
             if cmd not in self._command_table:
-                self.port.write("ERR HELP unknown command {}\r\n".format(cmd))
+                self._error("HELP unknown command {}".format(cmd))
                 return
             c_list = [cmd]
         else:
@@ -493,30 +1505,389 @@ class CommandLine:
                 l += " <channel>"
             for i in range(c_min):
                 l += " <arg>"
-            for i in range(c_min, c_max):
-                l += " [<arg>]"
-            l += "\r\n"
-            self.port.write(l)
-            self.port.write("HELP     {}\r\n".format(c_help))
+            if c_max - c_min > 2:
+                l += " [<arg> ...]"
+            else:
+                for i in range(c_min, c_max):
+                    l += " [<arg>]"
+            self._reply(l)
+            self._reply("HELP     {}".format(c_help))
 
     def _do_id(self):
-        self.port.write("ID {}\r\n".format(read_ID()))
+        self._reply("ID {}".format(read_ID()))
+
+    def _check_async(self, tl, arg):
+        self._parse_tristate_arg(arg)
 
     def _do_async(self, arg):
         self.async_state = bool(self._parse_tristate_arg(arg))
-        self.port.write("ASYNC {} OK\r\n".format(arg.upper()))
+        self._reply("ASYNC {} OK".format(arg.upper()))
+
+    @staticmethod
+    def _parse_history_period(period):
+        period = int(period)
+        if period < 0 or period > 3600:
+            raise ValueError("History period must be between 0 and 3600 seconds")
+        return period
+
+    @staticmethod
+    def _parse_history_length(length):
+        length = int(length)
+        if length < 0 or length > MAX_HISTORY_LENGTH:
+            raise ValueError("History length must be between 0 and {} samples".format(MAX_HISTORY_LENGTH))
+        return length
+
+    @staticmethod
+    def _parse_history_count(count):
+        count = int(count)
+        if count < 0:
+            raise ValueError("Sample count can not be negative")
+        return count
+
+    def _check_history(self, tl, *arg):
+        if arg and arg[0].upper() == "LENGTH":
+            if len(arg) > 1:
+                self._parse_history_length(arg[1])
+            return
+        if not self.history:
+            raise ValueError("history is not being kept")
+        if arg and arg[0].upper() == "PERIOD":
+            if len(arg) > 1:
+                self._parse_history_period(arg[1])
+        elif arg:
+            self._parse_history_count(arg[0])
+
+    def _do_history(self, *arg):
+        if arg and arg[0].upper() == "LENGTH":
+            if len(arg) > 1:
+                # The buffer is allocated at start up, so this takes effect
+                # from the next start once the configuration is saved
+                self.history_length = self._parse_history_length(arg[1])
+                self._reply("HISTORY LENGTH {} OK".format(self.history_length))
+            else:
+                self._reply("HISTORY LENGTH {}".format(self.history_length))
+            return
+        h = self.history
+        if arg and arg[0].upper() == "PERIOD":
+            if len(arg) > 1:
+                period = self._parse_history_period(arg[1])
+                # Samples at the old period can't be mixed with the new ones
+                h.period = period
+                h.clear()
+                self._reply("HISTORY PERIOD {} OK".format(period))
+            else:
+                self._reply("HISTORY PERIOD {}".format(h.period))
+            return
+        count = h.count
+        if arg:
+            count = min(self._parse_history_count(arg[0]), count)
+        first = h.count - count
+        # The header gives the number of samples, the sample period and the
+        # age in seconds of the newest sample
+        self._reply("HISTORY {} {} {}".format(count, h.period, h.age()))
+        if self.binary:
+            per_frame = FRAME_PAYLOAD_MAX // HISTORY_RECORD_SIZE
+            k = first
+            while k < h.count:
+                end = min(k + per_frame, h.count)
+                n = FRAME_HEADER_SIZE
+                while k < end:
+                    n = h.pack(self._frame, n, k)
+                    k += 1
+                self._send_frame(FRAME_HISTORY, n - FRAME_HEADER_SIZE, self._tag)
+                self._sent += 1
+        else:
+            # Send as many lines at once as fit in the output buffer
+            buf = self._out
+            n = 0
+            for k in range(first, h.count):
+                self._sent += 1
+                n = self._put_tag(n, self._tag)
+                n = put_bytes(buf, n, b"HISTORY ")
+                n = h.format(buf, n, k)
+                n = put_bytes(buf, n, b"\r\n")
+                if n > OUTPUT_BUFFER - 128:
+                    self.port.write(self._out_mv[:n])
+                    n = 0
+            if n:
+                self.port.write(self._out_mv[:n])
+
+    def _do_gcstats(self, *arg):
+        n = self.gc_count
+        self._reply("GCSTATS COUNT={} TOTAL={} MEAN={} MAX={} FREE={} ALLOC={}".format(
+            n, self.gc_total, self.gc_total // n if n else 0, self.gc_max, gc.mem_free(), gc.mem_alloc()))
+        if arg and arg[0].upper() == "RESET":
+            self.gc_count = 0
+            self.gc_total = 0
+            self.gc_max = 0
+
+    def _do_loopstats(self, *arg):
+        # One line per measurement, in microseconds, then the lowest free
+        # memory and the longest interval between watchdog feeds in ms
+        stats = self.stats
+        for k, name in enumerate(stats.NAMES):
+            p50, p90, p99, p_max = stats.percentiles(k)
+            self._reply("LOOPSTATS {} N={} P50={} P90={} P99={} MAX={}".format(
+                name, stats.counts[k], p50, p90, p99, p_max))
+        self._reply("LOOPSTATS MEMLOW={} WDTMAX={}".format(stats.mem_low, stats.wdt_max))
+        if arg and arg[0].upper() == "RESET":
+            stats.clear()
+
+    def _parse_report(self, therm, arg):
+        # Arguments are DEADBAND=<t>, MIN=<s>, MAX=<s> and EDGE=ON|OFF.
+        # Returns the new policy for the thermostat.
+        deadband, p_min, p_max, edge = therm.report_deadband, therm.report_min, therm.report_max, therm.report_edge
+        for a in arg:
+            k, _, v = a.upper().partition("=")
+            if k == "DEADBAND":
+                deadband = float(v)
+                if deadband < 0 or deadband > 10:
+                    raise ValueError("Deadband must be between 0 and 10 C")
+            elif k == "MIN" or k == "MAX":
+                v = int(v)
+                if v < 0 or v > 65535:
+                    raise ValueError("Report intervals must be between 0 and 65535 seconds")
+                if k == "MIN":
+                    p_min = v
+                else:
+                    p_max = v
+            elif k == "EDGE":
+                edge = bool(self._parse_tristate_arg(v))
+            else:
+                raise ValueError("unknown reporting setting {}".format(k))
+        return deadband, p_min, p_max, edge
+
+    def _check_report(self, tl, *arg):
+        for t in tl:
+            self._parse_report(self.t_list[t], arg)
+
+    def _do_report(self, therm, *arg):
+        # The policy is only changed if all the arguments are valid
+        deadband, p_min, p_max, edge = self._parse_report(therm, arg)
+        therm.report_deadband, therm.report_min, therm.report_max, therm.report_edge = deadband, p_min, p_max, edge
+        self._reply("REPORT {} DEADBAND={} MIN={} MAX={} EDGE={}{}".format(
+            therm.index, deadband, p_min, p_max, "ON" if edge else "OFF", " OK" if arg else ""))
+
+    @staticmethod
+    def _parse_rtc(arg):
+        if len(arg) != 2:
+            raise ValueError("RTC needs a date and a time")
+        y, mo, d = (int(i) for i in arg[0].split("-"))
+        h, mi, s = (int(i) for i in arg[1].split(":"))
+        # The RTC would roll an invalid day over into the next month
+        if (y < 2000 or y > 2099 or mo < 1 or mo > 12 or d < 1 or d > days_in_month(y, mo) or
+                h > 23 or mi > 59 or s > 59):
+            raise ValueError("invalid date or time")
+        return (y, mo, d, day_of_week(y, mo, d) + 1, h, mi, s, 0)
+
+    def _check_rtc(self, tl, *arg):
+        if arg:
+            self._parse_rtc(arg)
+
+    def _do_rtc(self, *arg):
+        if arg:
+            self.rtc.datetime(self._parse_rtc(arg))
+            # Run the schedules at once, catching up if the clock moved on
+            self._sched_due = 0
+        y, mo, d, wd, h, mi, s, _ = self.rtc.datetime()
+        self._reply("RTC {:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}{}".format(
+            y, mo, d, h, mi, s, " OK" if arg else ""))
+
+    def _parse_schedule(self, current, arg):
+        # Returns the thermostat's new schedule, given its current one
+        a = arg[0].upper()
+        if a == "NONE":
+            if len(arg) > 1:
+                raise ValueError("SCHEDULE NONE takes no entries")
+            schedule = []
+        else:
+            if a == "ADD":
+                arg = arg[1:]
+            entries = [self._parse_schedule_entry(i) for i in arg]
+            schedule = current + entries if a == "ADD" else entries
+            if len(schedule) > SCHEDULE_MAX:
+                raise ValueError("Schedules have at most {} entries".format(SCHEDULE_MAX))
+            schedule.sort(key=lambda e: e[1])
+        return schedule
+
+    def _check_schedule(self, tl, *arg):
+        if arg:
+            checked = self._checked_schedules
+            for t in tl:
+                checked[t] = self._parse_schedule(checked.get(t, self.t_list[t].schedule), arg)
+
+    def _do_schedule(self, therm, *arg):
+        if not arg:
+            for e in therm.schedule:
+                self._reply("SCHEDULE {} {}".format(therm.index, self._format_schedule_entry(e)))
+            if not therm.schedule:
+                self._reply("SCHEDULE {} NONE".format(therm.index))
+            return
+        schedule = self._parse_schedule(therm.schedule, arg)
+        therm.schedule = schedule
+        # Put the new schedule into effect now
+        now, _ = self._clock_minute()
+        if now >= 0:
+            therm.apply_schedule(-1, now)
+        self._reply("SCHEDULE {} {} OK".format(therm.index, len(schedule)))
+
+    def _check_proto(self, tl, *mode):
+        if mode and mode[0].upper() not in ("TEXT", "BIN"):
+            raise ValueError("Protocol must be TEXT or BIN")
+
+    def _do_proto(self, *mode):
+        if len(mode) == 0:
+            self._reply("PROTO {}".format("BIN" if self.binary else "TEXT"))
+            return
+        m = mode[0].upper()
+        if m not in ("TEXT", "BIN"):
+            raise ValueError("Protocol must be TEXT or BIN")
+        # Acknowledge using the old protocol, so the host knows where the switch happens
+        self._reply("PROTO {} OK".format(m))
+        self.binary = (m == "BIN")
+
+def _centi(v):
+    return int(v * 100 + (0.5 if v >= 0 else -0.5))
+
+def pack_config(conf):
+    g = struct.pack(CONFIG_GLOBAL_RECORD, conf["monitor"], conf["n_chan"],
+                    conf["history_period"], conf["history_length"])
+    parts = [struct.pack("<BB", CONFIG_GLOBAL, len(g)), g]
+    for i, t in enumerate(conf["therms"]):
+        o = t["override"]
+        c = struct.pack(CONFIG_CHANNEL_RECORD, i, _centi(t["set_point"]), _centi(t["dead_zone"]),
+                        -1 if o is None else o, _centi(t["adjust"]),
+                        _centi(t.get("time_constant", DEFAULT_TIME_CONSTANT)))
+        parts.append(struct.pack("<BB", CONFIG_CHANNEL, len(c)))
+        parts.append(c)
+        schedule = t.get("schedule")
+        if schedule:
+            c = bytearray(struct.pack("<B", i))
+            for mask, minute, sp in schedule:
+                c.extend(struct.pack(CONFIG_SCHEDULE_ENTRY, mask, minute, _centi(sp)))
+            parts.append(struct.pack("<BB", CONFIG_SCHEDULE, len(c)))
+            parts.append(bytes(c))
+        report = t.get("report")
+        if report:
+            deadband, p_min, p_max, edge = report
+            c = struct.pack(CONFIG_REPORT_RECORD, i, _centi(deadband), p_min, p_max, 1 if edge else 0)
+            parts.append(struct.pack("<BB", CONFIG_REPORT, len(c)))
+            parts.append(c)
+    return b"".join(parts)
+
+def unpack_config(payload):
+    config = {}
+    therms = {}
+    schedules = {}
+    reports = {}
+    n = 0
+    while n + 2 <= len(payload):
+        tag = payload[n]
+        size = payload[n+1]
+        data = payload[n+2:n+2+size]
+        n += 2 + size
+        if tag == CONFIG_GLOBAL:
+            (config["monitor"], config["n_chan"],
+             config["history_period"], config["history_length"]) = struct.unpack(CONFIG_GLOBAL_RECORD, data)
+        elif tag == CONFIG_CHANNEL:
+            i, set_point, dead_zone, override, adjust, tc = struct.unpack(CONFIG_CHANNEL_RECORD, data)
+            therms[i] = {"set_point": set_point / 100,
+                         "dead_zone": dead_zone / 100,
+                         "override": override,
+                         "adjust": adjust / 100,
+                         "time_constant": tc / 100}
+        elif tag == CONFIG_SCHEDULE:
+            schedules[data[0]] = [(mask, minute, sp / 100)
+                                  for mask, minute, sp in (struct.unpack_from(CONFIG_SCHEDULE_ENTRY, data, k)
+                                                           for k in range(1, len(data), CONFIG_SCHEDULE_ENTRY_SIZE))]
+        elif tag == CONFIG_REPORT:
+            i, deadband, p_min, p_max, edge = struct.unpack(CONFIG_REPORT_RECORD, data)
+            reports[i] = (deadband / 100, p_min, p_max, bool(edge))
+    for i, schedule in schedules.items():
+        if i in therms:
+            therms[i]["schedule"] = schedule
+    for i, report in reports.items():
+        if i in therms:
+            therms[i]["report"] = report
+    if therms:
+        config["therms"] = [therms[i] for i in sorted(therms)]
+    return config
+
+def _config_slot(i):
+    return "/flash/config-{}.bin".format(i)
+
+# The payload, sequence number and slot of the most recently loaded or
+# saved configuration
+_config_payload = None
+_config_seq = 0
+_config_slot_used = -1
+
+def read_config_slots():
+    # Return the newest configuration payload with a good CRC, or None
+    global _config_payload, _config_seq, _config_slot_used
+    best = None
+    for i in range(CONFIG_SLOTS):
+        try:
+            with open(_config_slot(i), "rb") as fh:
+                header = fh.read(CONFIG_HEADER_SIZE)
+                magic, seq, size, crc = struct.unpack(CONFIG_HEADER, header)
+                if magic != CONFIG_MAGIC or (best is not None and seq <= best[0]):
+                    continue
+                payload = fh.read(size)
+        except:
+            continue
+        if len(payload) == size and binascii.crc32(payload) & 0xffffffff == crc:
+            best = (seq, i, payload)
+    if best is None:
+        return None
+    _config_seq, _config_slot_used, _config_payload = best
+    return _config_payload
+
+def save_config(conf):
+    global _config_payload, _config_seq, _config_slot_used
+    payload = pack_config(conf)
+    if payload == _config_payload:
+        # Nothing has changed, so save the flash a write
+        return
+    seq = _config_seq + 1
+    slot = (_config_slot_used + 1) % CONFIG_SLOTS
+    data = bytearray(struct.pack(CONFIG_HEADER, CONFIG_MAGIC, seq, len(payload),
+                                 binascii.crc32(payload) & 0xffffffff))
+    data.extend(payload)
+    # Pad to whole sectors so that later saves overwrite the file in place
+    data.extend(bytes(-len(data) % CONFIG_SECTOR))
+    fn = _config_slot(slot)
+    try:
+        fh = open(fn, "r+b")
+        if fh.seek(0, 2) != len(data):
+            fh.close()
+            raise OSError
+        fh.seek(0)
+    except OSError:
+        fh = open(fn, "wb")
+    with fh:
+        fh.write(data)
+    os.sync()
+    _config_payload, _config_seq, _config_slot_used = payload, seq, slot
 
 def load_config():
     t_defs = {"set_point":DEFAULT_SET_POINT,
               "dead_zone":DEFAULT_DEAD_ZONE,
               "override": None,
               "adjust": 0.0,
+              "time_constant": DEFAULT_TIME_CONSTANT,
+              "schedule": (),
               }
     config = {}
-    try:
-        config = json.load(open("/flash/config.json"))
-    except:
-        debug("Could not load config file")
+    payload = read_config_slots()
+    if payload is not None:
+        config = unpack_config(payload)
+    else:
+        # Fall back to the configuration saved by older firmware
+        try:
+            config = json.load(open("/flash/config.json"))
+        except:
+            debug("Could not load config file")
 
     if "monitor" not in config:
         config["monitor"] = DEFAULT_MONITOR
@@ -524,6 +1895,12 @@ def load_config():
     if "n_chan" not in config:
         config["n_chan"] = HARDWARE_CHANNELS
 
+    if "history_period" not in config:
+        config["history_period"] = DEFAULT_HISTORY_PERIOD
+
+    if "history_length" not in config:
+        config["history_length"] = DEFAULT_HISTORY_LENGTH
+
     if "therms" not in config:
         config["therms"] = [t_defs] * HARDWARE_CHANNELS
     else:
@@ -552,13 +1929,18 @@ def run(exit_allowed=True, wdt_timeout=None):
     relay_pin_names = ["Y{}".format(8-i) for i in range(HARDWARE_CHANNELS)]
     
     adc_list = [pyb.ADC(pyb.Pin(p)) for p in adc_pin_names]
+    if hasattr(pyb.ADC, "read_timed_multi"):
+        sampler = Sampler(adc_list)
+        adc_list = sampler.channels
     relay_list = [pyb.Pin(p, pyb.Pin.OUT_PP) for p in relay_pin_names]
     tr_list = [Thermistor(adc, ref_r, beta, r_inf) for adc in adc_list]
     t_list = [Thermostat(tr, relay, i+1, **config["therms"][i]) for i,(tr, relay) in enumerate(zip(tr_list, relay_list))]
 
     serial_port.write("STARTING pyboard multi-thermostat version {}\r\n".format(__version__))
     
-    cmd_proc = CommandLine(serial_port, n_chan, t_list, exit_allowed=exit_allowed, monitor_period=config["monitor"], wdt_timeout=wdt_timeout)
+    history = History(config["history_period"], config["history_length"]) if config["history_length"] else None
+
+    cmd_proc = CommandLine(serial_port, n_chan, t_list, exit_allowed=exit_allowed, monitor_period=config["monitor"], wdt_timeout=wdt_timeout, history=history)
     cmd_proc.command_loop()
 
 def main():
@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
-from bottle import route, run, get, post, request, redirect, static_file
+from bottle import route, run, get, post, request, response, redirect, abort, install
 import os, re
 from os.path import join
 import argparse
+import json
+import queue
+import threading
+import time
 from collections import defaultdict
 
-from thermoboard import ThermoBoard
+from thermoboard import CommandError, format_schedule_entry
+from boardmanager import BoardManager
+from history import HistoryStore, auto_resolution
+from assets import AssetCache
+import metrics
 
 static_root = "/home/nicko/multitherm/rest_server/static"
 
@@ -19,8 +27,16 @@ def locate_linux_micropython_devs():
     def tty_for_device(d):
         l = os.listdir(join(devices_path, d, d+":1.1", "tty"))
         return join("/dev", l[0])
-    l = [i for i in os.listdir(devices_path) if usb_device_re.match(i)]
-    return [tty_for_device(i) for i in l if vid_for_device(i) == micropython_vid]
+    r = []
+    for i in os.listdir(devices_path):
+        # Devices which are still being set up, or going away, are skipped
+        # until the next scan
+        try:
+            if usb_device_re.match(i) and vid_for_device(i) == micropython_vid:
+                r.append(tty_for_device(i))
+        except (OSError, IndexError):
+            pass
+    return r
 
 def parse_room_names(file_name):
     d = defaultdict(dict)
@@ -47,7 +63,8 @@ def build_zone_list(boards, device_name_map):
     boards.sort(key=lambda x:x.ID)
     l = []
     for b in boards:
-        for i in range(1, 9):
+        # Only the channels in operation are reported by the board
+        for i in range(1, b.n_chan + 1):
             if b.ID in device_name_map and i in device_name_map[b.ID]:
                 name = device_name_map[b.ID][i]
                 if name is None:
@@ -57,45 +74,399 @@ def build_zone_list(boards, device_name_map):
             l.append((b, i, name))
     return l
 
+def zone_info(i):
+    board, index, name = zone_list[i]
+    return {"ID":i,
+            "board_id":board.ID,
+            "index": index,
+            "roomname": name,
+            "online": board.connected}
+
+def zone_version(i):
+    board, index, name = zone_list[i]
+    return board.state_versions[index-1]
+
+def not_modified(version):
+    # Tag the response with the state version and check if the client has it already
+    etag = '"{}"'.format(version)
+    response.set_header("ETag", etag)
+    response.set_header("Cache-Control", "no-cache")
+    match = request.get_header("If-None-Match")
+    if match and (match.strip() == "*" or etag in [t.strip() for t in match.split(",")]):
+        response.status = 304
+        return True
+    return False
+
 def state_for_id(i, cached=True):
     board, index, name = zone_list[i]
-    r = {"ID":i,
-         "board_id":board.ID,
-         "index": index,
-         "roomname": name}
+    r = zone_info(i)
     s = board.get_cached_state(index) if cached else board.get_state(index)
-    r.update(s)
+    if s:
+        r.update(s)
     return r
 
+class EventStreams:
+    # Fans out state change events to every connected event stream client
+    def __init__(self, queue_size=100):
+        self._lock = threading.Lock()
+        self._queues = set()
+        self._queue_size = queue_size
+        # Each stream holds a server thread, so they are limited to leave
+        # threads for other requests
+        self.max_streams = 16
+
+    def subscribe(self):
+        # Returns None if there are already as many streams as allowed
+        q = queue.Queue(self._queue_size)
+        with self._lock:
+            if len(self._queues) >= self.max_streams:
+                return None
+            self._queues.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._queues.discard(q)
+
+    def publish(self, event, data, encoded=None):
+        # The caller may pass the data already encoded as JSON
+        if not self._queues:
+            return
+        msg = "event: {}\ndata: {}\n\n".format(event, encoded or json.dumps(data))
+        with self._lock:
+            queues = list(self._queues)
+        for q in queues:
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                # A client that can not keep up is dropped, and will
+                # reconnect and reload the full state
+                self.unsubscribe(q)
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait(None)
+
+event_streams = EventStreams()
+
+class SnapshotCache:
+    # The JSON encoding of each zone's state, and of the full all_states
+    # response, kept until the zone's state version or the connection to
+    # its board changes. Dictionary updates are atomic, so no lock is needed.
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._zones = {}
+        self._all = (None, None)
+
+    def _key(self, i):
+        return zone_version(i), zone_list[i][0].connected
+
+    def store(self, i, key, data):
+        self._zones[i] = (key, data)
+
+    def zone(self, i):
+        key = self._key(i)
+        c = self._zones.get(i)
+        if c is not None and c[0] == key:
+            return c[1]
+        r = state_for_id(i)
+        r["version"] = key[0]
+        data = json.dumps(r)
+        self._zones[i] = (key, data)
+        return data
+
+    def all_states(self, versions):
+        key = (tuple(versions), tuple(b.connected for b in pool.boards))
+        c = self._all
+        if c[0] == key:
+            return c[1]
+        data = '{{"version": {}, "all_states": [{}]}}'.format(
+            max(versions, default=0), ", ".join(self.zone(i) for i in range(len(versions))))
+        self._all = (key, data)
+        return data
+
+snapshots = SnapshotCache()
+
+# Clients are asked to reconnect after this many seconds, so that the
+# server's worker threads are never held indefinitely
+STREAM_MAX_AGE = 600
+STREAM_KEEPALIVE = 15
+
+def state_changed(board, index, state):
+    i = zone_index.get((board.ID, index))
+    if i is None:
+        return
+    if history:
+        history.record(board.ID, index, state)
+    publish_state(i, state)
+
+def publish_state(i, state):
+    board, index, name = zone_list[i]
+    r = zone_info(i)
+    r.update(state)
+    r["version"] = zone_version(i)
+    data = json.dumps(r)
+    snapshots.store(i, (r["version"], board.connected), data)
+    event_streams.publish("state", r, data)
+
+def rebuild_zones(initial=False):
+    # Zones of boards which have been lost are kept, and zones of new boards
+    # go on the end, so that zone IDs never change once they are handed out.
+    # Only the first build is in board ID order.
+    global zone_list, zone_index, zones_built
+    with zone_lock:
+        if initial:
+            zl = build_zone_list(pool.boards, room_names)
+            zones_built = True
+        elif zones_built:
+            known = set(b.ID for b, index, name in zone_list)
+            new_boards = [b for b in pool.boards if b.ID not in known]
+            if not new_boards:
+                return
+            zl = zone_list + build_zone_list(new_boards, room_names)
+        else:
+            # Boards found before the first build are included by it
+            return
+        zone_index = {(b.ID, index): i for i, (b, index, name) in enumerate(zl)}
+        zone_list = zl
+        snapshots.clear()
+    event_streams.publish("zones", {"count": len(zl)})
+
+def board_connected(board, new):
+    # The boards run their schedules on local time
+    try:
+        board.set_clock()
+    except CommandError as e:
+        print("Could not set the clock of board {}: {}".format(board.ID, e))
+    if new:
+        rebuild_zones()
+    if history:
+        backfill_history([board])
+
+def clock_sync(interval):
+    # Keep the boards' clocks from drifting, and follow daylight saving changes
+    while True:
+        time.sleep(interval)
+        board_errors(pool.set_clock()[1])
+
+def board_lost(board):
+    # The board's state versions have moved on, so tell clients it is offline
+    for i, (b, index, name) in enumerate(zone_list):
+        if b is board:
+            publish_state(i, board.state_list[index-1] or {})
+
+def board_errors(errors):
+    # Report per-board failures from a pool operation
+    for b, e in errors.items():
+        print("Board {} failed: {}: {}".format(b.ID, e.__class__.__name__, e))
+    return {str(b.ID): "{}: {}".format(e.__class__.__name__, e) for b, e in errors.items()}
+
+def backfill_history(boards):
+    # Record the samples the boards kept while the server was not listening to them
+    results, errors = pool.map(lambda b: b.get_history(), boards=boards)
+    board_errors(errors)
+    for b, samples in results.items():
+        n = 0
+        for b_id, chan in zone_index:
+            if b_id == b.ID:
+                n += history.backfill(b_id, chan, [(t, states[chan-1]) for t, states in samples])
+        print("Backfilled {} samples from board {}".format(n, b.ID))
+
+http_seconds = metrics.Histogram("thermo_http_request_seconds", "Time taken to handle HTTP requests",
+                                 ("method", "route"))
+
+class RequestTimer:
+    # Bottle plugin recording the time taken by each route
+    name = "request_timer"
+    api = 2
+
+    def apply(self, callback, route):
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                http_seconds.observe(time.perf_counter() - t0, route.method, route.rule)
+        return timed
+
+def zone_gauge(key):
+    # Samples of one field of the cached state of every zone which has one
+    def samples():
+        for i, (board, index, name) in enumerate(zone_list):
+            s = board.state_list[index-1]
+            if s is not None and s.get(key) is not None:
+                yield (i, name), s[key]
+    return samples
+
+metrics.Gauge("thermo_zone_temperature_celsius", "Zone temperature", ("zone", "room"), zone_gauge("t"))
+metrics.Gauge("thermo_zone_set_point_celsius", "Zone set point", ("zone", "room"), zone_gauge("set"))
+metrics.Gauge("thermo_zone_output", "Zone heating relay state", ("zone", "room"), zone_gauge("out"))
+metrics.Gauge("thermo_board_connected", "Whether the connection to a board is open", ("board",),
+              lambda: [((b.ID,), int(b.connected)) for b in pool.boards])
+metrics.Gauge("thermo_board_commands_in_flight", "Commands sent to a board and not yet completed", ("board",),
+              lambda: [((b.ID,), b.board.in_flight) for b in pool.boards])
+
+# The firmware's loop statistics, fetched at most once a second for all
+# the gauges that report them
+_loopstats = (0, {})
+
+def board_loopstats():
+    global _loopstats
+    t, stats = _loopstats
+    if time.monotonic() - t > 1:
+        stats = pool.map(lambda b: b.get_loopstats(), deadline=1.0)[0]
+        _loopstats = (time.monotonic(), stats)
+    return stats
+
+def loop_time_samples():
+    for b, stats in board_loopstats().items():
+        for stat, v in stats.items():
+            if isinstance(v, dict):
+                for q in ("p50", "p90", "p99", "max"):
+                    yield (b.ID, stat, q), v[q]
+
+metrics.Gauge("thermo_board_loop_microseconds", "Recent firmware loop timings", ("board", "stat", "quantile"),
+              loop_time_samples)
+metrics.Gauge("thermo_board_memory_low_bytes", "Lowest free memory seen by the firmware", ("board",),
+              lambda: [((b.ID,), s["memlow"]) for b, s in board_loopstats().items()])
+metrics.Gauge("thermo_board_watchdog_max_milliseconds", "Longest interval between firmware watchdog feeds", ("board",),
+              lambda: [((b.ID,), s["wdtmax"]) for b, s in board_loopstats().items()])
+
+@get("/metrics")
+def metrics_exposition():
+    if not metrics.enabled:
+        abort(404, "Metrics are disabled")
+    response.content_type = metrics.CONTENT_TYPE
+    return metrics.exposition()
+
 @route('/')
 def root():
     redirect("/index.html")
 
+def send_asset(name):
+    a, hashed = assets.get(name)
+    if a is None:
+        abort(404, "File not found")
+    if a.variants:
+        # Set before any 304, so caches know which coding a tag belongs to
+        response.set_header("Vary", "Accept-Encoding")
+    coding, data = a.encoded(request.get_header("Accept-Encoding"))
+    if hashed:
+        # The name changes whenever the content does
+        response.set_header("Cache-Control", "public, max-age=31536000, immutable")
+    else:
+        response.set_header("Cache-Control", "no-cache")
+        # Each coding is a different body, so needs its own tag
+        etag = '"{}-{}"'.format(a.digest, coding) if coding else '"{}"'.format(a.digest)
+        response.set_header("ETag", etag)
+        if etag in [t.strip() for t in request.get_header("If-None-Match", "").split(",")]:
+            response.status = 304
+            return ""
+    response.content_type = a.content_type
+    if coding:
+        response.set_header("Content-Encoding", coding)
+    return data
+
 @route('/favicon.ico')
 def favicon():
-    return static_file("T.png", static_root)
+    return send_asset("T.png")
 
 @route("/index.html")
 def index():
-    return static_file("index.html", static_root)
+    return send_asset("index.html")
 
 @route("/static/<filepath:path>")
 def static_content(filepath):
-    return static_file(filepath, static_root)
+    return send_asset(filepath)
     
 @get("/thermostats")
 def thermostats():
     return {"count": len(zone_list),
             "names": [i[2] for i in zone_list] }
 
+@get("/thermostats/events")
+def thermostat_events():
+    response.content_type = "text/event-stream"
+    response.set_header("Cache-Control", "no-cache")
+    q = event_streams.subscribe()
+    if q is None:
+        # The dashboard falls back to polling
+        abort(503, "Too many event streams")
+    def stream():
+        try:
+            yield "retry: 1000\n\n"
+            end = time.monotonic() + STREAM_MAX_AGE
+            while time.monotonic() < end:
+                try:
+                    msg = q.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if msg is None:
+                    break
+                yield msg
+        finally:
+            event_streams.unsubscribe(q)
+    return stream()
+
 @get("/thermostats/all_states")
 def thermostats_all_states():
-    return {"all_states": [state_for_id(i) for i in range(len(zone_list))]}
+    # Read the versions before the states, so a concurrent change can only
+    # make the version we report older than the state
+    versions = [zone_version(i) for i in range(len(zone_list))]
+    version = max(versions, default=0)
+    since = request.query.since
+    if since:
+        # Only return the zones that have changed since the given version
+        try:
+            since = int(since)
+        except ValueError:
+            abort(400, "Invalid since version: {}".format(since))
+        response.content_type = "application/json"
+        return '{{"version": {}, "all_states": [{}]}}'.format(
+            version, ", ".join(snapshots.zone(i) for i, v in enumerate(versions) if v > since))
+    if not_modified(version):
+        return ""
+    response.content_type = "application/json"
+    return snapshots.all_states(versions)
 
 @get("/thermostat/<id:int>")
 def thermostat_info(id):
     i = int(id)
-    return state_for_id(i)
+    if not_modified(zone_version(i)):
+        return ""
+    response.content_type = "application/json"
+    return snapshots.zone(i)
+
+@get("/thermostat/<id:int>/history")
+def thermostat_history(id):
+    i = int(id)
+    if not history:
+        abort(404, "History is not being recorded")
+    if i < 0 or i >= len(zone_list):
+        abort(404, "No such thermostat")
+    board, index, name = zone_list[i]
+    try:
+        t_to = float(request.query.get("to") or time.time())
+        t_from = float(request.query.get("from") or (t_to - 86400))
+    except ValueError:
+        abort(400, "Times must be in seconds since the epoch")
+    resolution = request.query.get("resolution") or auto_resolution(t_from, t_to)
+    try:
+        records = history.query(board.ID, index, t_from, t_to, resolution)
+    except ValueError as e:
+        abort(400, str(e))
+    if resolution == "raw":
+        fields = ["time", "t", "set", "out", "override"]
+    else:
+        fields = ["time", "min", "max", "mean", "duty"]
+    return {"ID": i,
+            "from": t_from,
+            "to": t_to,
+            "resolution": resolution,
+            "fields": fields,
+            "records": records}
 
 @post("/thermostat/<id:int>")
 def thermostat_set(id):
@@ -103,34 +474,140 @@ def thermostat_set(id):
     board, index, name = zone_list[i]
     settings = request.json
     errs = []
-    for k, v in settings.items():
-        print("Setting key {} to value {}".format(k,v))
-        if k == "setpoint":
-            board.set_set_point(index, v)
-        elif k == "override":
-            board.set_override(index, v)
-        elif k == "adjust":
-            board.set_adjust(index, v)
-        else:
-            errs.append("Unknown setting key: {}".format(k))
-    r = state_for_id(i, cached=False)
+    try:
+        for k, v in settings.items():
+            print("Setting key {} to value {}".format(k,v))
+            if k == "setpoint":
+                board.set_set_point(index, v)
+            elif k == "override":
+                board.set_override(index, v)
+            elif k == "adjust":
+                board.set_adjust(index, v)
+            else:
+                errs.append("Unknown setting key: {}".format(k))
+        r = state_for_id(i, cached=False)
+    except CommandError as e:
+        abort(503, str(e))
     if errs:
         r['errs'] = errs
     return r
 
+@post("/thermostats/batch")
+def thermostats_batch():
+    # Settings for many zones, as an object mapping zone IDs to the same
+    # settings as for a single thermostat. The settings for each board
+    # are sent together, and the boards are updated concurrently.
+    settings = request.json
+    if not isinstance(settings, dict):
+        abort(400, "Batch must be an object mapping thermostat IDs to settings")
+    by_board = defaultdict(dict)
+    errs = defaultdict(list)
+    for k, v in settings.items():
+        try:
+            i = int(k)
+            board, index, name = zone_list[i]
+        except (ValueError, IndexError):
+            abort(404, "No such thermostat: {}".format(k))
+        if not isinstance(v, dict):
+            abort(400, "Settings for thermostat {} must be an object".format(i))
+        for key in v:
+            if key not in ("setpoint", "override", "adjust"):
+                errs[i].append("Unknown setting key: {}".format(key))
+        by_board[board][index] = v
+    by_id = {b.ID: v for b, v in by_board.items()}
+    results, errors = pool.map(lambda b: b.apply_settings(by_id[b.ID]), boards=list(by_board))
+    states = []
+    for board, (board_states, board_errs) in results.items():
+        for index, state in board_states.items():
+            i = zone_index[(board.ID, index)]
+            r = zone_info(i)
+            r.update(state)
+            r["version"] = zone_version(i)
+            states.append(r)
+        for index, e in board_errs.items():
+            errs[zone_index[(board.ID, index)]].extend(e)
+    for board, e in errors.items():
+        for index in by_board[board]:
+            errs[zone_index[(board.ID, index)]].append("{}: {}".format(e.__class__.__name__, e))
+    r = {"all_states": sorted(states, key=lambda x: x["ID"])}
+    if errs:
+        r["errs"] = {str(i): e for i, e in sorted(errs.items())}
+    return r
+
+def parse_schedule(i, entries):
+    if not isinstance(entries, list):
+        abort(400, "Schedule for thermostat {} must be a list of entries".format(i))
+    try:
+        for e in entries:
+            format_schedule_entry(e)
+    except (ValueError, KeyError, TypeError) as e:
+        abort(400, "Invalid schedule for thermostat {}: {}".format(i, e))
+    return entries
+
+@get("/thermostat/<id:int>/schedule")
+def thermostat_schedule(id):
+    i = int(id)
+    if i < 0 or i >= len(zone_list):
+        abort(404, "No such thermostat")
+    board, index, name = zone_list[i]
+    try:
+        return {"ID": i, "schedule": board.get_schedule(index)}
+    except CommandError as e:
+        abort(503, str(e))
+
+@post("/thermostat/<id:int>/schedule")
+def thermostat_set_schedule(id):
+    # The schedule is a list of entries, each an object giving the days
+    # (1 for Monday to 7 for Sunday), the time ("HH:MM") and the setpoint
+    i = int(id)
+    if i < 0 or i >= len(zone_list):
+        abort(404, "No such thermostat")
+    board, index, name = zone_list[i]
+    entries = parse_schedule(i, (request.json or {}).get("schedule"))
+    try:
+        board.set_schedule(index, entries)
+        return {"ID": i, "schedule": board.get_schedule(index)}
+    except CommandError as e:
+        abort(503, str(e))
+
+@post("/thermostats/schedules")
+def thermostats_schedules():
+    # Schedules for many zones, as an object mapping zone IDs to lists of
+    # entries. The boards are updated concurrently.
+    schedules = request.json
+    if not isinstance(schedules, dict):
+        abort(400, "Schedules must be an object mapping thermostat IDs to lists of entries")
+    by_board = defaultdict(dict)
+    for k, v in schedules.items():
+        try:
+            i = int(k)
+            board, index, name = zone_list[i]
+        except (ValueError, IndexError):
+            abort(404, "No such thermostat: {}".format(k))
+        by_board[board][index] = parse_schedule(i, v)
+    by_id = {b.ID: v for b, v in by_board.items()}
+    results, errors = pool.map(lambda b: b.set_schedules(by_id[b.ID]), boards=list(by_board))
+    r = {"result": "Failed" if errors else "OK",
+         "IDs": sorted(zone_index[(b.ID, index)] for b in results for index in by_board[b])}
+    if errors:
+        r["errs"] = {str(zone_index[(b.ID, index)]): "{}: {}".format(e.__class__.__name__, e)
+                     for b, e in errors.items() for index in by_board[b]}
+    return r
+
+def config_result(results, errors):
+    r = {"result": "Failed" if errors else "OK",
+         "boards": sorted(b.ID for b in results)}
+    if errors:
+        r["errors"] = board_errors(errors)
+    return r
+
 @post("/config/saveconfig")
 def saveconfig():
-    boards = set(board for board, index, name in zone_list)
-    for board in boards:
-        board.saveconfig()
-    return {"result":"OK"}
+    return config_result(*pool.saveconfig())
 
 @post("/config/restoreconfig")
 def restoreconfig():
-    boards = set(board for board, index, name in zone_list)
-    for board in boards:
-        board.loadconfig()
-    return {"result":"OK"}
+    return config_result(*pool.loadconfig())
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Web service for a multi-channel thermostat system')
@@ -142,28 +619,72 @@ def parse_args():
                         help="start the server for localhost only")
     parser.add_argument('--port', '-p', metavar="PORT", type=int, default=27315,
                         help="specify port number on which to open server")
+    parser.add_argument('--binary', '-b', action="store_true",
+                        help="use the binary protocol to talk to the thermostat boards")
+    parser.add_argument('--history', '-H', metavar="DIR",
+                        help="record zone history in the given directory")
+    parser.add_argument('--deadline', metavar="SECONDS", type=float, default=5.0,
+                        help="time allowed for each board to complete an operation on all boards")
+    parser.add_argument('--scan-interval', metavar="SECONDS", type=float, default=2.0,
+                        help="interval between checks for boards being plugged in or lost")
+    parser.add_argument('--clock-sync', metavar="SECONDS", type=float, default=3600,
+                        help="interval between setting the boards' clocks, or 0 to only set them on connection")
+    parser.add_argument('--no-metrics', action="store_true",
+                        help="do not record metrics or serve /metrics")
+    parser.add_argument('--static', metavar="DIR", default=static_root,
+                        help="directory holding the dashboard files")
+    parser.add_argument('--threads', '-t', metavar="COUNT", type=int, default=32,
+                        help="number of server threads")
+    parser.add_argument('--max-streams', metavar="COUNT", type=int,
+                        help="number of dashboards given pushed updates, the rest poll (default half the threads)")
     args = parser.parse_args()
     return args
 
 zone_list = []
+# Maps (board ID, channel) to the zone's index in zone_list
+zone_index = {}
+zones_built = False
+history = None
+pool = None
+assets = None
+room_names = {}
+zone_lock = threading.Lock()
 
 def main():
     args = parse_args()
-    board_paths = args.device if args.device else locate_linux_micropython_devs()
-    name_map = parse_room_names(args.rooms) if args.rooms else {}
+    if args.device:
+        locate = lambda: args.device
+    else:
+        locate = locate_linux_micropython_devs
     host_address = 'localhost' if args.private else '0.0.0.0'
-    
-    print("Starting thermostat server for devices: {}".format(board_paths))
-    
-    boards = [ThermoBoard(p) for p in board_paths]
-    global zone_list
-    zone_list = build_zone_list(boards, name_map)
-    [b.start_async() for b in boards]
+    if args.no_metrics:
+        metrics.enabled = False
+    else:
+        install(RequestTimer())
+
+    print("Starting thermostat server for devices: {}".format(locate()))
 
-    run(server='paste', host=host_address, port=args.port)
+    global history, pool, room_names, assets
+    event_streams.max_streams = args.max_streams if args.max_streams is not None else args.threads // 2
+    assets = AssetCache(args.static)
+    room_names = parse_room_names(args.rooms) if args.rooms else {}
+    if args.history:
+        history = HistoryStore(args.history)
+    manager = BoardManager(locate, binary=args.binary, deadline=args.deadline, async_callback=state_changed,
+                           on_change=board_connected, on_lost=board_lost, scan_interval=args.scan_interval)
+    pool = manager.pool
+    manager.start()
+    rebuild_zones(initial=True)
+    if args.clock_sync:
+        threading.Thread(target=clock_sync, args=(args.clock_sync,), daemon=True, name="Clock sync").start()
+
+    run(server='paste', host=host_address, port=args.port,
+        threadpool_workers=args.threads, daemon_threads=True)
     print("Stopping async threads for boards")
-    [b.stop_async() for b in boards]
+    manager.stop()
+    board_errors(pool.stop_async()[1])
+    if history:
+        history.close()
 
 if __name__ == "__main__":
     main()
-    
@@ -0,0 +1,124 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from os.path import join, splitext
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Types worth compressing; images are already compressed
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# Types of files whose names have no extension
+NAMED_TYPES = {"vue": "application/javascript"}
+
+# References to other static files from HTML, CSS and JavaScript
+STATIC_REF = re.compile(r"(/?static/)([\w.\-]+)")
+
+class Asset:
+    def __init__(self, name, data, content_type):
+        self.name = name
+        self.data = data
+        self.content_type = content_type
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+        base, ext = splitext(name)
+        self.hashed_name = "{}.{}{}".format(base, self.digest, ext)
+        # Encoded variants of the data, by content coding
+        self.variants = {}
+        if content_type.startswith(COMPRESSIBLE):
+            self.variants["gzip"] = gzip.compress(data, 9, mtime=0)
+            if brotli:
+                self.variants["br"] = brotli.compress(data)
+            # Only keep variants which are actually smaller
+            self.variants = {k: v for k, v in self.variants.items() if len(v) < len(data)}
+
+    def encoded(self, accept_encoding):
+        """Return the content coding, or None, and data to send to a client
+        with the given Accept-Encoding header"""
+        accepted = _accepted_codings(accept_encoding)
+        for coding in ("br", "gzip"):
+            if coding in self.variants and coding in accepted:
+                return coding, self.variants[coding]
+        return None, self.data
+
+def _accepted_codings(header):
+    r = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        r.add(coding.strip().lower())
+    return r
+
+class AssetCache:
+    """The static files, loaded into memory with compressed variants
+
+    Each file is also available under a name including a hash of its
+    contents, which can be cached by clients forever. References from
+    HTML, CSS and JavaScript files to other static files are rewritten
+    to use the hashed names, so a change to any file changes the names
+    of the files that refer to it."""
+    def __init__(self, root):
+        self.root = root
+        self._by_name = {}
+        self._by_hashed_name = {}
+        raw = {}
+        for name in sorted(os.listdir(root)):
+            if os.path.isfile(join(root, name)):
+                with open(join(root, name), "rb") as fh:
+                    raw[name] = fh.read()
+        # Resolve files before the files that refer to them; any left in a
+        # cycle of references are loaded without rewriting
+        pending = dict(raw)
+        while pending:
+            progress = False
+            for name, data in list(pending.items()):
+                refs = set(self._references(name, data, raw)) - {name}
+                if refs.isdisjoint(pending):
+                    self._add(name, self._rewrite(name, data, raw))
+                    del pending[name]
+                    progress = True
+            if not progress:
+                for name, data in pending.items():
+                    self._add(name, data)
+                break
+
+    def _content_type(self, name):
+        t = NAMED_TYPES.get(name) or mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if t.startswith("text/"):
+            t += "; charset=utf-8"
+        return t
+
+    def _references(self, name, data, raw):
+        if not self._content_type(name).startswith(COMPRESSIBLE):
+            return []
+        return [m.group(2) for m in STATIC_REF.finditer(data.decode("utf-8", "replace")) if m.group(2) in raw]
+
+    def _rewrite(self, name, data, raw):
+        if not self._references(name, data, raw):
+            return data
+        def hashed(m):
+            a = self._by_name.get(m.group(2))
+            return "/static/" + a.hashed_name if a and m.group(2) != name else m.group(0)
+        return STATIC_REF.sub(hashed, data.decode("utf-8")).encode("utf-8")
+
+    def _add(self, name, data):
+        a = Asset(name, data, self._content_type(name))
+        self._by_name[name] = a
+        self._by_hashed_name[a.hashed_name] = a
+
+    def get(self, name):
+        """Return the asset and whether it was found by its hashed name, or (None, False)"""
+        a = self._by_hashed_name.get(name)
+        if a is not None:
+            return a, True
+        return self._by_name.get(name), False
@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+from thermoboard import AsyncThermoBoard, BoardPool, ThermoBoard, board_event_loop
+
+# Interval between scans for boards that have been plugged in or lost, in seconds
+SCAN_INTERVAL = 2.0
+# Bounds of the delay before retrying a device that could not be opened, in seconds
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+class BoardManager:
+    """Keeps a BoardPool connected to whichever boards are plugged in
+
+    The device paths returned by the locate function are scanned
+    periodically, and new devices are opened in the background on the
+    board event loop. Boards whose connections are lost are reopened when
+    they reappear, on any path. Devices which fail to open are retried
+    with exponential backoff.
+
+    Each board ID keeps the same ThermoBoard object across reconnections,
+    so code holding it sees the board come back. The on_change callback is
+    called, on a worker thread, with the ThermoBoard and whether it is a
+    board not seen before, each time a board is connected, and the on_lost
+    callback is called with the ThermoBoard when its connection is found
+    to have been lost."""
+    def __init__(self, locate, binary=False, command_timeout=2.0, deadline=5.0,
+                 async_callback=None, on_change=None, scan_interval=SCAN_INTERVAL, on_lost=None):
+        self.pool = BoardPool(deadline=deadline)
+        self.binary = binary
+        self.command_timeout = command_timeout
+        self.async_callback = async_callback
+        self.on_change = on_change
+        self.on_lost = on_lost
+        self.scan_interval = scan_interval
+        self._locate = locate
+        self._loop = board_event_loop()
+        # The board open on each path, every board seen by ID, and the
+        # (time, delay) of the next attempt on paths that failed to open
+        self._by_path = {}
+        self._by_id = {}
+        self._retry = {}
+        self._task = None
+
+    def start(self):
+        """Open the boards present now, then watch for changes in the background"""
+        asyncio.run_coroutine_threadsafe(self._scan(), self._loop).result()
+        self._task = asyncio.run_coroutine_threadsafe(self._watch(), self._loop)
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.scan_interval)
+            try:
+                await self._scan()
+            except Exception as e:
+                print("Board scan failed: {}: {}".format(e.__class__.__name__, e))
+
+    async def _scan(self):
+        for path, tb in list(self._by_path.items()):
+            if not tb.connected:
+                print("Lost connection to board {} on {}".format(tb.ID, path))
+                del self._by_path[path]
+                if self.on_lost:
+                    self._loop.run_in_executor(None, self.on_lost, tb)
+        now = time.monotonic()
+        paths = [p for p in self._locate()
+                 if p not in self._by_path and self._retry.get(p, (0, 0))[0] <= now]
+        if paths:
+            await asyncio.gather(*[self._open(p) for p in paths])
+
+    async def _open(self, path):
+        b = None
+        try:
+            b = await asyncio.wait_for(AsyncThermoBoard.open(path, self.binary, self.command_timeout),
+                                       self.pool.deadline)
+            tb = self._by_id.get(b.ID)
+            if tb is not None and tb.connected:
+                raise ValueError("board {} is already connected".format(b.ID))
+            if tb is None:
+                tb = ThermoBoard.wrap(b)
+            else:
+                tb.attach(b)
+            tb.async_callback = self.async_callback
+            await asyncio.wait_for(b.start_async(), self.pool.deadline)
+        except Exception as e:
+            if b is not None:
+                await b.close()
+            delay = min(MAX_BACKOFF, 2 * self._retry[path][1]) if path in self._retry else MIN_BACKOFF
+            self._retry[path] = (time.monotonic() + delay, delay)
+            print("Could not open board on {}: {}: {}; retrying in {:.0f}s".format(
+                path, e.__class__.__name__, e, delay))
+            return
+        self._retry.pop(path, None)
+        self._by_path[path] = tb
+        new = b.ID not in self._by_id
+        if new:
+            self._by_id[b.ID] = tb
+            self.pool.boards = sorted(self.pool.boards + [tb], key=lambda x: x.ID)
+        print("Connected to board {} on {}".format(b.ID, path))
+        if self.on_change:
+            # The callback may well use the board, which would deadlock on this thread
+            self._loop.run_in_executor(None, self.on_change, tb, new)
@@ -0,0 +1,296 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from os.path import join
+
+# Raw samples: timestamp, temperature and set point in hundredths of a
+# degree, output state and override (-1 for none)
+SAMPLE_RECORD = struct.Struct("<dhhBbxx")
+# Set point of samples backfilled from the board's own history, which
+# does not record it
+UNKNOWN_SET_POINT = -32768
+# Rollups: bucket start time, minimum, maximum and mean temperature in
+# hundredths of a degree and the output duty cycle in hundredths of a percent
+ROLLUP_RECORD = struct.Struct("<dhhhHxx")
+
+# Number of records in each segment file
+SEGMENT_RECORDS = 65536
+
+# Rollup resolutions, in seconds
+ROLLUP_PERIODS = {"1m": 60, "1h": 3600}
+
+# A state is assumed to hold until the next sample, but not for longer than this
+MAX_GAP = 3600
+
+def _centi(v):
+    return int(round(v * 100))
+
+class Series:
+    """An append-only series of fixed-size, time-ordered records
+
+    The records are kept in memory-mapped segment files, each holding a
+    fixed number of records. Unused records are zero, so the number of
+    records in the last segment is found by a binary search at startup.
+    Time ranges are found by binary search on the timestamps, which are
+    the first field of every record."""
+    def __init__(self, path, prefix, record):
+        self._path = path
+        self._prefix = prefix
+        self._record = record
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        names = sorted(i for i in os.listdir(path) if i.startswith(prefix + "-") and i.endswith(".dat"))
+        self._segments = [int(i[len(prefix)+1:-4]) for i in names]
+        # Start time of each segment, so queries can skip whole segments
+        self._starts = []
+        for n in self._segments:
+            with self._map(n) as m:
+                self._starts.append(self._time(m, 0))
+        self._tail = None
+        self._tail_count = 0
+        if self._segments:
+            self._open_tail(self._segments[-1])
+
+    def _file(self, n):
+        return join(self._path, "{}-{:06d}.dat".format(self._prefix, n))
+
+    def _map(self, n, write=False):
+        with open(self._file(n), "r+b" if write else "rb") as fh:
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+
+    def _time(self, m, i):
+        return struct.unpack_from("<d", m, i * self._record.size)[0]
+
+    def _count(self, m):
+        # Records are never written with a zero timestamp
+        lo, hi = 0, SEGMENT_RECORDS
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time(m, mid):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _open_tail(self, n):
+        if self._tail is not None:
+            self._tail.close()
+        self._tail = self._map(n, write=True)
+        self._tail_count = self._count(self._tail)
+
+    def _new_segment(self, t):
+        n = self._segments[-1] + 1 if self._segments else 0
+        with open(self._file(n), "wb") as fh:
+            fh.truncate(SEGMENT_RECORDS * self._record.size)
+        self._segments.append(n)
+        self._starts.append(t)
+        self._open_tail(n)
+
+    def last_time(self):
+        with self._lock:
+            if not self._tail_count:
+                return None
+            return self._time(self._tail, self._tail_count - 1)
+
+    def append(self, *values):
+        with self._lock:
+            if self._tail is None or self._tail_count == SEGMENT_RECORDS:
+                self._new_segment(values[0])
+            self._record.pack_into(self._tail, self._tail_count * self._record.size, *values)
+            self._tail_count += 1
+
+    def _search(self, m, count, t):
+        # Index of the first record at or after time t
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time(m, mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, t_from, t_to):
+        """Return the records with timestamps from t_from up to but excluding t_to"""
+        r = []
+        with self._lock:
+            segments = list(zip(self._segments, self._starts))
+            tail_count = self._tail_count
+        for i, (n, start) in enumerate(segments):
+            if start >= t_to:
+                break
+            if i + 1 < len(segments) and segments[i+1][1] <= t_from:
+                continue
+            with self._map(n) as m:
+                count = tail_count if i == len(segments) - 1 else SEGMENT_RECORDS
+                lo = self._search(m, count, t_from)
+                hi = self._search(m, count, t_to)
+                size = self._record.size
+                r.extend(self._record.iter_unpack(m[lo*size:hi*size]))
+        return r
+
+    def close(self):
+        with self._lock:
+            if self._tail is not None:
+                self._tail.close()
+                self._tail = None
+
+class Rollup:
+    # Accumulates time-weighted statistics for fixed-length time buckets
+    def __init__(self, series, period):
+        self.series = series
+        self.period = period
+        self._last = None
+        self._reset(None)
+
+    def _reset(self, bucket):
+        self._bucket = bucket
+        self._min = None
+        self._max = None
+        self._integral = 0.0
+        self._on_time = 0.0
+        self._covered = 0.0
+
+    def _flush(self):
+        if self._covered > 0:
+            self.series.append(self._bucket, self._min, self._max,
+                               int(round(self._integral / self._covered)),
+                               int(round(10000 * self._on_time / self._covered)))
+
+    def _hold(self, t_from, t_to, temp, out):
+        # Account for a state holding over an interval within the current bucket
+        dt = t_to - t_from
+        self._min = temp if self._min is None else min(self._min, temp)
+        self._max = temp if self._max is None else max(self._max, temp)
+        self._integral += temp * dt
+        self._on_time += dt if out else 0.0
+        self._covered += dt
+
+    def resume(self, samples):
+        # Replay the raw samples since the last complete bucket, so that the
+        # bucket that was in progress when the store was closed carries on
+        last = self.series.last_time()
+        start = 0.0 if last is None else last + self.period
+        end = samples.last_time()
+        if end is None or end < start:
+            return
+        before = samples.range(start - MAX_GAP, start)
+        if before:
+            # The state at the start of the bucket held from an earlier sample
+            t, temp, set_point, out, override = before[-1]
+            self._reset(start)
+            self._last = (start, temp, out)
+        for t, temp, set_point, out, override in samples.range(start, end + 1):
+            self.add(t, temp, out)
+
+    def add(self, t, temp, out):
+        if self._last is not None:
+            last_t, last_temp, last_out = self._last
+            end = min(t, last_t + MAX_GAP)
+            while last_t < end:
+                bucket_end = self._bucket + self.period
+                seg_end = min(end, bucket_end)
+                self._hold(last_t, seg_end, last_temp, last_out)
+                last_t = seg_end
+                if last_t >= bucket_end:
+                    self._flush()
+                    self._reset(bucket_end)
+        bucket = t - (t % self.period)
+        if bucket != self._bucket:
+            self._flush()
+            self._reset(bucket)
+        self._min = temp if self._min is None else min(self._min, temp)
+        self._max = temp if self._max is None else max(self._max, temp)
+        self._last = (t, temp, out)
+
+class ZoneHistory:
+    def __init__(self, path):
+        self.samples = Series(path, "raw", SAMPLE_RECORD)
+        self.rollups = {}
+        for name, period in ROLLUP_PERIODS.items():
+            r = Rollup(Series(path, name, ROLLUP_RECORD), period)
+            r.resume(self.samples)
+            self.rollups[name] = r
+
+    def add(self, t, state):
+        last = self.samples.last_time()
+        if last is not None and t <= last:
+            # Keep the series in time order, even if the clock steps back
+            t = last + 1e-6
+        temp = _centi(state["t"])
+        out = state["out"]
+        set_point = state.get("set")
+        override = state.get("override")
+        self.samples.append(t, temp, UNKNOWN_SET_POINT if set_point is None else _centi(set_point),
+                            out, -1 if override is None else override)
+        for r in self.rollups.values():
+            r.add(t, temp, out)
+
+    def close(self):
+        self.samples.close()
+        for r in self.rollups.values():
+            r.series.close()
+
+def auto_resolution(t_from, t_to):
+    # Pick a resolution that keeps the number of records returned manageable
+    span = t_to - t_from
+    if span <= 86400:
+        return "raw"
+    elif span <= 31 * 86400:
+        return "1m"
+    return "1h"
+
+class HistoryStore:
+    """Per-zone history of the state reports received from the boards"""
+    def __init__(self, root):
+        self.root = root
+        self._zones = {}
+        self._lock = threading.Lock()
+
+    def _zone(self, board_id, channel):
+        key = (board_id, channel)
+        with self._lock:
+            z = self._zones.get(key)
+            if z is None:
+                z = ZoneHistory(join(self.root, "board{}-chan{}".format(board_id, channel)))
+                self._zones[key] = z
+        return z
+
+    def record(self, board_id, channel, state, t=None):
+        self._zone(board_id, channel).add(time.time() if t is None else t, state)
+
+    def backfill(self, board_id, channel, samples):
+        """Record (time, state) samples taken while the server was not
+        listening, skipping any that are not newer than the history"""
+        z = self._zone(board_id, channel)
+        last = z.samples.last_time()
+        n = 0
+        for t, state in samples:
+            if last is None or t > last:
+                z.add(t, state)
+                n += 1
+        return n
+
+    def query(self, board_id, channel, t_from, t_to, resolution="raw"):
+        """Return the raw samples or rollups for a zone over a time range
+
+        Samples are (time, temperature, set point, output, override)
+        tuples and rollups are (start time, minimum, maximum, mean, duty
+        cycle) tuples, with the duty cycle being a fraction."""
+        z = self._zone(board_id, channel)
+        if resolution == "raw":
+            return [(t, temp / 100.0, None if set_point == UNKNOWN_SET_POINT else set_point / 100.0,
+                     out, None if override < 0 else override)
+                    for t, temp, set_point, out, override in z.samples.range(t_from, t_to)]
+        if resolution not in z.rollups:
+            raise ValueError("Unknown resolution: {}".format(resolution))
+        return [(t, lo / 100.0, hi / 100.0, mean / 100.0, duty / 10000.0)
+                for t, lo, hi, mean, duty in z.rollups[resolution].series.range(t_from, t_to)]
+
+    def close(self):
+        with self._lock:
+            for z in self._zones.values():
+                z.close()
+            self._zones.clear()
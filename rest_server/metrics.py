@@ -0,0 +1,117 @@
+import bisect
+import threading
+
+# Recording can be switched off, leaving each instrumented call site with
+# the cost of a single test
+enabled = True
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_registry = []
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names, values, extra=""):
+    parts = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def lines(self):
+        yield "# TYPE {} {}".format(self.name, self.kind)
+        yield "# HELP {} {}".format(self.name, self.help)
+        for labels, value in self.samples():
+            yield from self.format(labels, value)
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n=1):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def format(self, labels, value):
+        yield "{}_total{} {}".format(self.name, _labels(self.label_names, labels), value)
+
+class Gauge(Metric):
+    """A gauge whose samples are read from a function when the metrics
+    are collected, so it costs nothing until then"""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self):
+        return list(self.fn()) if self.fn else []
+
+    def format(self, labels, value):
+        yield "{}{} {}".format(self.name, _labels(self.label_names, labels), value)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        if not enabled:
+            return
+        # Counts are kept per bucket, and only made cumulative for output
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._values.get(labels)
+            if h is None:
+                h = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += value
+
+    def samples(self):
+        with self._lock:
+            return [(k, list(v)) for k, v in self._values.items()]
+
+    def format(self, labels, h):
+        n = 0
+        for le, count in zip(self.buckets + ("+Inf",), h):
+            n += count
+            yield "{}_bucket{} {}".format(self.name, _labels(self.label_names, labels, 'le="{}"'.format(le)), n)
+        yield "{}_count{} {}".format(self.name, _labels(self.label_names, labels), n)
+        yield "{}_sum{} {}".format(self.name, _labels(self.label_names, labels), h[-1])
+
+def exposition():
+    """Return all the metrics in the OpenMetrics text format"""
+    lines = []
+    for m in _registry:
+        lines.extend(m.lines())
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+# Metrics of the serial connections to the boards
+command_seconds = Histogram("thermo_command_seconds",
+                            "Time from sending a command to a board to receiving its last response",
+                            ("board", "command"))
+async_messages = Counter("thermo_async_messages", "State reports received from the boards unprompted", ("board",))
+protocol_errors = Counter("thermo_protocol_errors",
+                          "Frames and lines from the boards which were discarded or not expected", ("board", "kind"))
@@ -122,14 +122,17 @@ function merge_state_with_lock(old_state, new_state) {
     return res;
 }
 
+// The state version of the most recent reload
+var state_version = 0;
+
 function reload_states() {
-    axios.get("/thermostats/all_states")
+    // Only fetch the zones that changed since the last reload
+    axios.get("/thermostats/all_states", {params: {since: state_version}})
 	.then(function(response) {
 	    for (item in response.data.all_states) {
-		d = display_info_for_state(response.data.all_states[item]);
-		d = merge_state_with_lock(thermo_app.display_info[item], d);
-		thermo_app.display_info.splice(item, 1, d);
+		update_state(response.data.all_states[item]);
 	    }
+	    state_version = response.data.version;
 	}).catch(function (error) {
 	    console.log(error);
 	});
@@ -140,28 +143,65 @@ function reload_timer() {
     setTimeout(reload_timer, 10*1000);
 }
 
+function update_state(s) {
+    d = display_info_for_state(s);
+    d = merge_state_with_lock(thermo_app.display_info[s.ID], d);
+    thermo_app.display_info.splice(s.ID, 1, d);
+}
+
+function start_updates() {
+    if (!window.EventSource) {
+	// Fall back to polling on browsers without server-sent events
+	setTimeout(reload_timer, 10*1000);
+	return;
+    }
+    var source = new EventSource("/thermostats/events");
+    source.addEventListener("state", function(e) {
+	update_state(JSON.parse(e.data));
+    });
+    // The set of zones changes when a new board is plugged in
+    source.addEventListener("zones", function(e) {
+	load_all_states(false);
+    });
+    // Changes may have been missed while (re)connecting, so reload everything
+    source.addEventListener("open", reload_states);
+    // The server refuses streams when it has too many, so poll instead
+    source.addEventListener("error", function(e) {
+	if (source.readyState == EventSource.CLOSED) {
+	    setTimeout(reload_timer, 10*1000);
+	}
+    });
+}
+
 var thermo_app = new Vue({
     el: '#thermostats',
     data: {
 	display_info: []
     },
     created: function() {
-	axios.get("/thermostats/all_states")
-	    .then(function(response) {
-		while (thermo_app.display_info.length) {
-		    thermo_app.display_info.pop();
-		}
-		for (item in response.data.all_states) {
-		    d = display_info_for_state(response.data.all_states[item]);
-		    d.set_lock = 0;
-		    thermo_app.display_info.push(d);
-		}
-		setTimeout(reload_timer, 10*1000);
-	    })
-	    .catch(function (error) {
-		console.log(error);
-	    });
+	load_all_states(true);
     }
 })
 
+function load_all_states(start) {
+    axios.get("/thermostats/all_states")
+	.then(function(response) {
+	    while (thermo_app.display_info.length) {
+		thermo_app.display_info.pop();
+	    }
+	    for (item in response.data.all_states) {
+		d = display_info_for_state(response.data.all_states[item]);
+		d.set_lock = 0;
+		thermo_app.display_info.push(d);
+	    }
+	    state_version = response.data.version;
+	    if (start) {
+		start_updates();
+	    }
+	})
+	.catch(function (error) {
+	    console.log(error);
+	});
+}
+
 
@@ -1,8 +1,52 @@
 import serial
+import asyncio
+import contextlib
+import inspect
+import itertools
+import os
 import threading
-import select
+import struct
 import time
 
+import metrics
+
+# Binary protocol framing; see the PROTO command in Commands.md
+FRAME_SYNC = 0xA5
+FRAME_HEADER = struct.Struct("<BHH")
+FRAME_CHECKSUM = struct.Struct("<H")
+FRAME_RESPONSE = ord("R")
+FRAME_ERROR = ord("E")
+FRAME_STATE = ord("S")
+FRAME_ASYNC = ord("A")
+FRAME_MONITOR = ord("M")
+FRAME_HISTORY = ord("H")
+FRAME_END = ord("Z")
+END_RECORD = struct.Struct("<H")
+STATE_RECORD = struct.Struct("<BhhBhb")
+# Output bit mask and the temperature of each channel in hundredths of a degree
+HISTORY_RECORD = struct.Struct("<B8h")
+
+# Highest command tag; tags cycle through 1 to this value
+MAX_TAG = 65535
+
+# Limits on the length of a command line and the number of tokens in it,
+# set by the firmware's input buffer
+MAX_LINE = 255
+MAX_TOKENS = 64
+
+# State versions are shared by all boards, so the highest version seen
+# identifies the state of the whole system. They start from the current
+# time in milliseconds so that they keep increasing across restarts.
+_state_versions = itertools.count(int(time.time() * 1000))
+
+# Message kinds, as returned by _next_message()
+MSG_RESPONSE = "response"
+MSG_ERROR = "error"
+MSG_STATE = "state"
+MSG_ASYNC = "async"
+MSG_HISTORY = "history"
+MSG_END = "end"
+
 class CommandError(Exception):
     pass
 
@@ -25,181 +69,974 @@ def OneZeroNone(s):
 def chan_unpack(chan, rr):
     return rr if chan == "*" else rr[0]
 
-class ThermoBoard:
-    def __init__(self, path):
-        self._s = serial.Serial(path)
-        self._s.timeout = 0.25
-        self._drain()
-        self._cmd_lock = threading.Lock()
-        self.ID = self.get_ID()
+def format_schedule_entry(e):
+    """Convert a schedule entry dict, with days (1 for Monday to 7 for
+    Sunday), time ("HH:MM") and setpoint, to the board's form"""
+    days = sorted(set(int(d) for d in e["days"]))
+    if not days or days[0] < 1 or days[-1] > 7:
+        raise ValueError("Schedule days must be from 1 (Monday) to 7 (Sunday)")
+    h, _, m = str(e["time"]).partition(":")
+    if not (h.isdigit() and m.isdigit() and int(h) < 24 and int(m) < 60):
+        raise ValueError("Invalid schedule time: {}".format(e["time"]))
+    return "{}@{:02d}:{:02d}={}".format("".join(str(d) for d in days), int(h), int(m), float(e["setpoint"]))
+
+def parse_schedule_entry(s):
+    days, _, rest = s.partition("@")
+    t, _, set_point = rest.partition("=")
+    return {"days": [int(d) for d in days], "time": t, "setpoint": float(set_point)}
+
+def schedule_commands(channel, entries):
+    # Commands replacing a channel's schedule, split so that each fits on a line
+    entries = [format_schedule_entry(e) for e in entries]
+    if not entries:
+        return [("SCHEDULE", channel, "NONE")]
+    commands = []
+    cmd = ["SCHEDULE", channel]
+    for e in entries:
+        if len(cmd) > 3 and (len(" ".join(str(i) for i in cmd + [e])) > MAX_LINE - 20 or len(cmd) >= MAX_TOKENS - 4):
+            commands.append(tuple(cmd))
+            cmd = ["SCHEDULE", channel, "ADD"]
+        cmd.append(e)
+    commands.append(tuple(cmd))
+    return commands
+
+def report_args(deadband=None, min_interval=None, max_interval=None, edge=None):
+    # Arguments of a REPORT command changing the given parts of a policy
+    args = []
+    if deadband is not None:
+        args.append("DEADBAND={}".format(float(deadband)))
+    if min_interval is not None:
+        args.append("MIN={}".format(int(min_interval)))
+    if max_interval is not None:
+        args.append("MAX={}".format(int(max_interval)))
+    if edge is not None:
+        args.append("EDGE={}".format("ON" if edge else "OFF"))
+    return args
+
+def parse_report(r):
+    values = dict(i.split("=") for i in r[2:] if "=" in i)
+    return {"deadband": float(values["DEADBAND"]),
+            "min": int(values["MIN"]),
+            "max": int(values["MAX"]),
+            "edge": values["EDGE"] == "ON"}
+
+def split_tag(l):
+    # Remove the command tag from the start of a text line
+    if l[0] == "#":
+        t, _, l = l.partition(" ")
+        return int(t[1:]), l
+    return 0, l
+
+def unpack_states(payload):
+    return [{"chan": chan,
+             "t": t / 100.0,
+             "set": set_point / 100.0,
+             "out": out,
+             "adj": adj / 100.0,
+             "override": None if override < 0 else override}
+            for chan, t, set_point, out, adj, override in STATE_RECORD.iter_unpack(payload)]
+
+def parse_state(s):
+    convert = {"CHAN": int,
+               "T": float,
+               "SET": float,
+               "OUT": int,
+               "ADJ": float,
+               "OVERRIDE": OneZeroNone}
+    r = {}
+    for part in s:
+        k, v = part.split("=")
+        if k in convert:
+            v = convert[k](v)
+        r[k.lower()]=v
+    return r
+
+class _Request:
+    # A command which has been sent and is awaiting its responses, which
+    # are complete when the board sends the END message for its tag
+    def __init__(self, cmd, future):
+        self.tag = 0
+        self.cmd = cmd.upper()
+        # A batch of commands gets the responses for each of their verbs
+        self.verbs = set(c.split()[0].lstrip("!") for c in self.cmd.split(";") if c.strip())
+        # Set when the command is sent
+        self.board = None
+        self.sent = 0.0
+        self.responses = []
+        self.errors = []
+        self.received = 0
+        self.future = future
+
+    def add(self, kind, data):
+        if kind == MSG_END:
+            if self.errors:
+                self.future.set_exception(CommandError("Command returned error: {}".format("; ".join(self.errors))))
+            elif data != self.received:
+                self.future.set_exception(CommandError("Received {} of {} responses to {} request".format(
+                    self.received, data, self.cmd)))
+            else:
+                self.future.set_result(self.responses)
+            return
+        self.received += 1
+        if kind == MSG_ERROR:
+            self.errors.append(data)
+        elif kind == MSG_STATE and "STATE" in self.verbs:
+            # Binary state frames carry all the requested channels at once
+            self.responses.extend(data)
+        elif kind == MSG_HISTORY and "HISTORY" in self.verbs:
+            self.responses.extend(data)
+        elif kind != MSG_RESPONSE or data[0] not in self.verbs:
+            print("Unexpected response: {} {}, cmd={}".format(kind, data, self.cmd))
+            metrics.protocol_errors.inc(self.board, "unexpected")
+        else:
+            self.responses.append(data)
+            if data[0] == "RESET":
+                # The board restarts before it can end the response
+                self.future.set_result(self.responses)
+
+class AsyncThermoBoard:
+    """A thermostat board driven from an asyncio event loop
+
+    The serial port is watched by the event loop, so any number of boards
+    can share one loop with no threads and no polling. Use the open()
+    class method to create a connected board."""
+    def __init__(self, path, command_timeout=2.0):
+        self.path = path
+        self.command_timeout = command_timeout
+        self.ID = None
+        # Number of channels in operation, which '*' commands apply to
+        self.n_chan = 8
         self.state_list = [None] * 8
-        self._async_running = False
-        self._async_thread = None
+        # The state version at which each channel last changed
+        self.state_versions = [0] * 8
         self.async_callback = None
-        
-    def _drain(self):
+        self.connected = False
+        self._s = None
+        self._fd = None
+        self._loop = None
+        self._rx = bytearray()
+        self._tx = bytearray()
+        self._pending = {}
+        self._last_tag = 0
+        self._binary = False
+        self._async_running = False
+
+    @classmethod
+    async def open(cls, path, binary=False, command_timeout=2.0):
+        b = cls(path, command_timeout)
+        await b.connect()
+        try:
+            b.ID = await b.get_ID()
+            b.n_chan = await b.get_nchan()
+            if binary:
+                await b.set_binary()
+        except BaseException:
+            # Includes being cancelled when a deadline passes
+            await b.close()
+            raise
+        return b
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+        self._s = serial.Serial(self.path, timeout=0)
+        # Discard anything left over from before we connected
+        self._s.reset_input_buffer()
+        self._fd = self._s.fileno()
+        self._rx.clear()
+        self._tx.clear()
+        self._binary = False
+        self.connected = True
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    @property
+    def label(self):
+        # Identifies the board in metrics, by its path until the ID is known
+        return self.path if self.ID is None else str(self.ID)
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._connection_lost(e)
+            return
+        if not data:
+            self._connection_lost(None)
+            return
+        self._rx += data
+        while self.connected:
+            try:
+                m = self._next_message()
+            except (ValueError, IndexError, UnicodeDecodeError, struct.error) as e:
+                print("Discarding message that could not be parsed: {}: {}".format(e.__class__.__name__, e))
+                metrics.protocol_errors.inc(self.label, "parse")
+                continue
+            if m is None:
+                break
+            self._dispatch(*m)
+
+    def _on_writable(self):
+        try:
+            n = os.write(self._fd, self._tx)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._connection_lost(e)
+            return
+        del self._tx[:n]
+        if not self._tx:
+            self._loop.remove_writer(self._fd)
+
+    def _write(self, data):
+        if not self._tx:
+            try:
+                n = os.write(self._fd, data)
+            except BlockingIOError:
+                n = 0
+            data = data[n:]
+            if not data:
+                return
+            self._loop.add_writer(self._fd, self._on_writable)
+        self._tx += data
+
+    def _connection_lost(self, exc):
+        if exc:
+            print("Connection to board {} lost: {}: {}".format(self.ID, exc.__class__.__name__, exc))
+        self._shutdown(CommandError("Connection to board closed"))
+
+    def _shutdown(self, exc):
+        if not self.connected:
+            return
+        self.connected = False
+        # The states are no longer live, so clients holding them must refetch
+        for i in range(len(self.state_versions)):
+            self.state_versions[i] = next(_state_versions)
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self._s.close()
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for req in pending:
+            if not req.future.done():
+                req.future.set_exception(exc)
+
+    def _next_frame(self):
+        # Returns the frame type, tag and payload, or None if no whole frame is buffered
+        rx = self._rx
+        while rx:
+            i = rx.find(FRAME_SYNC)
+            if i != 0:
+                n = len(rx) if i < 0 else i
+                print("Discarding {} unframed bytes: {}".format(n, bytes(rx[:n])))
+                metrics.protocol_errors.inc(self.label, "unframed")
+                del rx[:n]
+                continue
+            h_end = 1 + FRAME_HEADER.size
+            if len(rx) < h_end:
+                return None
+            f_type, tag, n = FRAME_HEADER.unpack_from(rx, 1)
+            f_end = h_end + n + FRAME_CHECKSUM.size
+            if len(rx) < f_end:
+                return None
+            frame = memoryview(bytes(rx[:f_end]))
+            del rx[:f_end]
+            payload = frame[h_end:h_end+n]
+            checksum, = FRAME_CHECKSUM.unpack_from(frame, h_end+n)
+            if sum(frame[1:h_end+n]) & 0xffff != checksum:
+                print("Discarding frame of type {} with bad checksum".format(chr(f_type)))
+                metrics.protocol_errors.inc(self.label, "checksum")
+                continue
+            return f_type, tag, payload
+        return None
+
+    def _next_message(self):
+        # Take a single message from the receive buffer in either protocol.
+        # Returns a (kind, tag, data) tuple, where data is the response
+        # tokens, the error text or a list of state dicts, or None if no
+        # whole message has been received
+        while self._binary:
+            f = self._next_frame()
+            if f is None:
+                return None
+            f_type, tag, payload = f
+            if f_type == FRAME_RESPONSE:
+                ll = bytes(payload).decode("ASCII").split()
+                if not ll:
+                    raise ValueError("empty response frame")
+                return MSG_RESPONSE, tag, ll
+            elif f_type == FRAME_ERROR:
+                return MSG_ERROR, tag, bytes(payload).decode("ASCII")
+            elif f_type == FRAME_STATE:
+                return MSG_STATE, tag, unpack_states(payload)
+            elif f_type == FRAME_ASYNC or f_type == FRAME_MONITOR:
+                return MSG_ASYNC, tag, unpack_states(payload)
+            elif f_type == FRAME_HISTORY:
+                return MSG_HISTORY, tag, list(HISTORY_RECORD.iter_unpack(payload))
+            elif f_type == FRAME_END:
+                return MSG_END, tag, END_RECORD.unpack(payload)[0]
+            print("Received frame of unknown type {}".format(chr(f_type)))
+            metrics.protocol_errors.inc(self.label, "unknown_frame")
         while True:
-            _ = self._s.read(1024)
-            if not _:
+            i = self._rx.find(b"\n")
+            if i < 0:
+                return None
+            l = self._rx[:i].strip()
+            del self._rx[:i+1]
+            if l:
                 break
+        tag, l = split_tag(l.decode("ASCII"))
+        ll = l.split()
+        if not ll:
+            return MSG_RESPONSE, tag, ["OK"]
+        if ll[0] == "ERR":
+            return MSG_ERROR, tag, l
+        elif ll[0] == "END":
+            return MSG_END, tag, int(ll[1])
+        elif ll[0] == "STATE":
+            return MSG_STATE, tag, [parse_state(ll[1:])]
+        elif ll[0] == "*ASYNC" or ll[0] == "*MONITOR":
+            return MSG_ASYNC, tag, [parse_state(ll[1:])]
+        elif ll[0][0] == "*":
+            print("Received unknown async message: {}".format(ll))
+            metrics.protocol_errors.inc(self.label, "unknown_async")
+        return MSG_RESPONSE, tag, ll
+
+    def _handle_async_message(self, kind, data):
+        if kind != MSG_ASYNC:
+            if data != ["OK"]:
+                print("Received non-async message asynchronously: {}".format(data))
+                metrics.protocol_errors.inc(self.label, "untagged")
+            return
+        metrics.async_messages.inc(self.label, n=len(data))
+        for state in data:
+            self._cache_state(state)
+            if self.async_callback:
+                try:
+                    r = self.async_callback(self, state["chan"], state)
+                    if inspect.isawaitable(r):
+                        asyncio.ensure_future(r)
+                except Exception as e:
+                    print("Async calback raised exception: {}: {}".format(e.__class__.__name__, e))
 
-    def _handle_async_message(self, m):
-        ll = m.decode("ASCII").strip().split()
-        if ll[0][0] != "*":
-            if ll[0] != "OK":
-                print("Received non-async message asynchronously: {}".format(ll))
+    def _dispatch(self, kind, tag, data):
+        if kind == MSG_RESPONSE and data and data[-1] == "OK":
+            # The board switches protocol as soon as it has acknowledged the
+            # change, so we must switch before reading anything else
+            if data[0] == "PROTO":
+                self._binary = (data[1] == "BIN")
+            elif data[0] == "RESET":
+                # The board always restarts using the text protocol
+                self._binary = False
+        req = self._pending.get(tag) if tag else None
+        if req is not None:
+            if not req.future.done():
+                req.add(kind, data)
+        elif kind == MSG_ASYNC:
+            self._handle_async_message(kind, data)
+        elif tag:
+            print("Response for unknown command tag {}: {} {}".format(tag, kind, data))
+            metrics.protocol_errors.inc(self.label, "unknown_tag")
         else:
-            if ll[0] == "*ASYNC" or ll[0] == "*MONITOR":
-                # print("ASYNC message: {}".format(ll))
-                state = self._parse_and_cache_state(ll[1:])
-                if self.async_callback:
-                    try:
-                        self.async_callback(self, state["chan"], state)
-                    except Exception as e:
-                        print("Async calback raised exception: {}: {}".format(e.__class__.__name__, e))
-            else:
-                print("Received unknown async message: {}".format(ll))
-
-    def _async_loop(self):
-        # print("Async thread starting: {} {}".format(self._async_running, self._s.is_open))
-        while self._async_running and self._s.is_open:
-            rl, wl, xl = select.select([self._s], [], [], 1)
-            if rl and self._s.is_open:
-                with self._cmd_lock:
-                    l = self._s.readline().strip()
-                    if l:
-                        self._handle_async_message(l)
-        # print("Async thread exiting: {} {}".format(self._async_running, self._s.is_open))
-                
-    def _run_command(self, cmd, *args, expect = 1, allow_few=False):
-        s = self._s
-        c = cmd
-        if args:
-            c += " "
-            c += " ".join(str(i) for i in args)
-        c += "\r\n"
-        rr = []
-        if expect == "*":
-            expect = (8 if args[0]=="*" else 1)
-        e = expect
-        # Serialise the communication on the serial port
-        with self._cmd_lock:
-            # print("Sending: {}".format(c))
-            s.write(c.encode("ASCII"))
-            while e:
-                l = s.readline().strip()
-                if not l:
+            self._handle_async_message(kind, data)
+
+    def _submit(self, cmd, *args):
+        # Send a tagged command and return the request tracking its responses
+        return self._submit_many([(cmd,) + args])[0]
+
+    def _submit_many(self, commands):
+        # Send a list of (command, arg, ...) tuples in a single write
+        if not self.connected:
+            raise CommandError("Connection to board closed")
+        reqs = []
+        c = ""
+        for cmd, *args in commands:
+            req = _Request(cmd, self._loop.create_future())
+            tag = self._last_tag
+            while True:
+                tag = (tag % MAX_TAG) + 1
+                if tag not in self._pending:
                     break
-                if l[0] == ord("*"):
-                    self._handle_async_message(l)
-                else:
-                    ll = l.decode("ASCII").strip().split()
-                    # print("Recieved: {}".format(ll))
-                    if ll[0] == "ERR":
-                        raise CommandError("Command returned error: {}".format(l))
-                    elif ll[0] != cmd.upper():
-                        print("Unexpected response line: {}, ll[0]={}, cmd={}".format(l, ll[0], cmd))
-                    else:
-                        rr.append(ll)
-                        e -= 1
-        if expect and not rr:
-            raise CommandError("No valid response to {} request".format(cmd))
-        if len(rr) != expect and not allow_few:
-            raise CommandError("Insufficient response lines to {} request".format(cmd))
-        return rr
+            self._last_tag = tag
+            req.tag = tag
+            req.board = self.label
+            self._pending[tag] = req
+            reqs.append(req)
+            c += "#{} {}".format(tag, cmd)
+            if args:
+                c += " "
+                c += " ".join(str(i) for i in args)
+            c += "\r\n"
+        # print("Sending: {}".format(c))
+        t = time.perf_counter()
+        for req in reqs:
+            req.sent = t
+        self._write(c.encode("ASCII"))
+        return reqs
 
-    def get_ID(self):
-        rr = self._run_command("ID")
+    async def _wait(self, req):
+        try:
+            return await asyncio.wait_for(asyncio.shield(req.future), self.command_timeout)
+        except asyncio.TimeoutError:
+            if not req.received:
+                raise CommandError("No valid response to {} request".format(req.cmd))
+            raise CommandError("Incomplete response to {} request".format(req.cmd))
+        finally:
+            self._pending.pop(req.tag, None)
+            if metrics.enabled:
+                cmd = next(iter(req.verbs)) if len(req.verbs) == 1 else "BATCH"
+                metrics.command_seconds.observe(time.perf_counter() - req.sent, req.board, cmd)
+
+    async def _run_command(self, cmd, *args):
+        return await self._wait(self._submit(cmd, *args))
+
+    async def get_ID(self):
+        rr = await self._run_command("ID")
         return int(rr[0][1])
 
-    def get_version(self):
-        rr = self._run_command("VERSION")
+    async def get_version(self):
+        rr = await self._run_command("VERSION")
         return rr[0][1]
 
-    def get_temp(self, channel):
-        rr = self._run_command("TEMP", channel, expect="*")
-        return chan_unpack(channel, [float(i[2]) for i in rr])
+    async def get_nchan(self):
+        rr = await self._run_command("NCHAN")
+        return int(rr[0][1])
 
-    @staticmethod
-    def _parse_state(s):
-        convert = {"CHAN": int,
-                   "T": float,
-                   "SET": float,
-                   "OUT": int,
-                   "ADJ": float,
-                   "OVERRIDE": OneZeroNone}
-        r = {}
-        for part in s:
-            k, v = part.split("=")
-            if k in convert:
-                v = convert[k](v)
-            r[k.lower()]=v
-        return r
+    async def get_temp(self, channel):
+        rr = await self._run_command("TEMP", channel)
+        return chan_unpack(channel, [float(i[2]) for i in rr])
 
-    def _parse_and_cache_state(self, s):
-        state = self._parse_state(s)
-        self.state_list[state['chan']-1] = state
+    def _cache_state(self, state):
+        i = state['chan']-1
+        if state != self.state_list[i]:
+            self.state_list[i] = state
+            self.state_versions[i] = next(_state_versions)
         return state
-    
-    def get_state(self, channel):
-        rr = self._run_command("STATE", channel, expect ="*")
-        return chan_unpack(channel, [self._parse_and_cache_state(i[1:]) for i in rr])
 
-    def get_cached_state(self, channel):
-        if not self._async_running:
-            print("ASYNC thread not started, using uncached state")
-            return self.get_state(channel)
+    def cached_state(self, channel):
+        # Only valid while async updates are running. Channels past NCHAN
+        # are not reported by the board, so have no state.
         if channel == "*":
-            return [i.copy() for i in self.state_list]
+            return [i and i.copy() for i in self.state_list]
         else:
             i = int(channel)
             if i<1 or i>8:
                 raise ValueError("Channel number must be between 1 and 8")
-            return self.state_list[i-1].copy()
+            s = self.state_list[i-1]
+            return s and s.copy()
+
+    async def get_state(self, channel):
+        rr = await self._run_command("STATE", channel)
+        return chan_unpack(channel, [self._cache_state(i) for i in rr])
+
+    async def get_cached_state(self, channel):
+        if not self._async_running:
+            print("ASYNC updates not started, using uncached state")
+            return await self.get_state(channel)
+        return self.cached_state(channel)
+
+    async def set_set_point(self, channel, temperature):
+        await self._run_command("SET", channel, temperature)
+
+    async def set_override(self, channel, override):
+        override = OneZeroNone(override)
+        await self._run_command("OVERRIDE", channel, override)
+
+    async def set_adjust(self, channel, offset):
+        await self._run_command("ADJUST", channel, offset)
+
+    async def run_batch(self, commands, atomic=False):
+        """Run a list of (command, arg, ...) tuples, with as many commands
+        on each line as the board accepts, and return all their responses
+
+        With atomic set the board runs none of the commands unless they
+        are all valid, and they must all fit on one line."""
+        lines = []
+        line, tokens = "", 0
+        for cmd in commands:
+            c = " ".join(str(i) for i in cmd)
+            # Leave room for a tag, the '!' and the line ending
+            if line and (len(line) + len(c) + 1 > MAX_LINE - 10 or tokens + len(cmd) + 1 > MAX_TOKENS - 2):
+                lines.append(line)
+                line, tokens = "", 0
+            line = line + ";" + c if line else c
+            tokens += len(cmd) + 1
+        if line:
+            lines.append(line)
+        if atomic:
+            if len(lines) > 1:
+                raise CommandError("Batch of {} commands is too long to run atomically".format(len(commands)))
+            lines = ["!" + l for l in lines]
+        reqs = self._submit_many([(l,) for l in lines])
+        outcomes = await asyncio.gather(*[self._wait(r) for r in reqs], return_exceptions=True)
+        rr = []
+        for r in outcomes:
+            if isinstance(r, Exception):
+                raise r
+            rr.extend(r)
+        return rr
+
+    # The command for each key accepted by apply_settings()
+    _setting_commands = {"setpoint": "SET", "override": "OVERRIDE", "adjust": "ADJUST"}
+
+    async def apply_settings(self, settings):
+        """Change the settings of many channels at once
+
+        settings maps channel numbers to dicts of setpoint, override and
+        adjust values. Where every channel in operation is given the same
+        value a single '*' command is used. All the commands, followed by
+        'STATE *', are sent in one write. Returns a dict of the new states
+        and a dict of lists of error messages, both keyed by channel."""
+        errors = {}
+        commands = []
+        for key, cmd in self._setting_commands.items():
+            values = {}
+            for chan, s in settings.items():
+                if key not in s:
+                    continue
+                try:
+                    values[chan] = OneZeroNone(s[key]) if key == "override" else float(s[key])
+                except (ValueError, TypeError) as e:
+                    errors.setdefault(chan, []).append(str(e))
+            if not values:
+                continue
+            if set(values) == set(range(1, self.n_chan + 1)) and len(set(values.values())) == 1:
+                commands.append((list(values), (cmd, "*", values[1])))
+            else:
+                commands.extend(([chan], (cmd, chan, v)) for chan, v in sorted(values.items()))
+        commands.append((list(settings), ("STATE", "*")))
+        reqs = self._submit_many([c for chans, c in commands])
+        outcomes = await asyncio.gather(*[self._wait(r) for r in reqs], return_exceptions=True)
+        for (chans, c), r in zip(commands, outcomes):
+            if isinstance(r, Exception):
+                for chan in chans:
+                    errors.setdefault(chan, []).append(str(r))
+        states = outcomes[-1]
+        if isinstance(states, Exception):
+            return {}, errors
+        states = {s["chan"]: self._cache_state(s) for s in states}
+        return {chan: states[chan] for chan in settings if chan in states}, errors
+
+    async def get_time_constant(self, channel):
+        rr = await self._run_command("FILTER", channel)
+        return chan_unpack(channel, [float(i[2]) for i in rr])
+
+    async def set_time_constant(self, channel, seconds):
+        await self._run_command("FILTER", channel, seconds)
+
+    async def get_history(self, count=None):
+        """Fetch the samples kept by the board, oldest first
+
+        Returns a list of (time, states) pairs, where states holds a dict
+        with the temperature and output of each channel."""
+        args = () if count is None else (count,)
+        rr = await self._run_command("HISTORY", *args)
+        now = time.time()
+        count, period, age = (int(i) for i in rr[0][1:4])
+        samples = []
+        for k, r in enumerate(rr[1:]):
+            if isinstance(r, tuple):
+                mask, temps = r[0], [i / 100.0 for i in r[1:]]
+            else:
+                mask, temps = int(r[2]), [float(i) for i in r[3:]]
+            t = now - age - (count - 1 - k) * period
+            samples.append((t, [{"chan": c+1, "t": temp, "out": (mask >> c) & 1}
+                                for c, temp in enumerate(temps)]))
+        return samples
+
+    async def get_history_period(self):
+        rr = await self._run_command("HISTORY", "PERIOD")
+        return int(rr[0][2])
+
+    async def set_history_period(self, seconds):
+        await self._run_command("HISTORY", "PERIOD", seconds)
+
+    async def get_history_length(self):
+        rr = await self._run_command("HISTORY", "LENGTH")
+        return int(rr[0][2])
+
+    async def set_history_length(self, count):
+        """Set the number of samples kept, from the next start once the configuration is saved"""
+        await self._run_command("HISTORY", "LENGTH", count)
+
+    async def get_loopstats(self, reset=False):
+        """Fetch the firmware's loop timing statistics
+
+        Returns a dict mapping each measurement name to a dict of the
+        sample count and the p50, p90, p99 and max times in microseconds,
+        along with memlow, the lowest free memory in bytes, and wdtmax,
+        the longest interval between watchdog feeds in milliseconds."""
+        rr = await self._run_command("LOOPSTATS", *(("RESET",) if reset else ()))
+        r = {}
+        for l in rr:
+            values = {k.lower(): int(v) for k, v in (i.split("=") for i in l[1:] if "=" in i)}
+            if "=" in l[1]:
+                r.update(values)
+            else:
+                r[l[1].lower()] = values
+        return r
+
+    async def get_report_policy(self, channel):
+        """Return the ASYNC reporting policy of a channel, as a dict of the
+        deadband, the min and max intervals in seconds and the edge flag"""
+        rr = await self._run_command("REPORT", channel)
+        return chan_unpack(channel, [parse_report(r) for r in rr])
+
+    async def set_report_policy(self, channel, deadband=None, min_interval=None, max_interval=None, edge=None):
+        """Change the given parts of the ASYNC reporting policy of a channel
+
+        Temperature changes larger than deadband are reported, at most once
+        every min_interval seconds. Every channel is reported at least once
+        every max_interval seconds, unless it is 0. With edge set only
+        output and set point changes are reported."""
+        await self._run_command("REPORT", channel, *report_args(deadband, min_interval, max_interval, edge))
+
+    async def get_clock(self):
+        """Return the board's clock, which runs on local time, in seconds since the epoch"""
+        rr = await self._run_command("RTC")
+        return time.mktime(time.strptime(rr[0][1] + " " + rr[0][2], "%Y-%m-%d %H:%M:%S"))
+
+    async def set_clock(self, t=None):
+        """Set the board's clock to the local time at t, or now"""
+        t = time.time() if t is None else t
+        await self._run_command("RTC", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(round(t))))
+
+    async def get_schedule(self, channel):
+        """Return the weekly schedule of a channel as a list of dicts of
+        days, time and setpoint, or a dict of them by channel for '*'"""
+        rr = await self._run_command("SCHEDULE", channel)
+        schedules = {}
+        for r in rr:
+            entries = schedules.setdefault(int(r[1]), [])
+            if r[2] != "NONE":
+                entries.append(parse_schedule_entry(r[2]))
+        return schedules if channel == "*" else schedules[int(channel)]
+
+    async def set_schedule(self, channel, entries):
+        await self.run_batch(schedule_commands(channel, entries))
+
+    async def set_schedules(self, schedules):
+        """Replace the schedules of many channels, given as a dict of lists
+        of entries keyed by channel, sending them together"""
+        commands = []
+        for chan, entries in sorted(schedules.items()):
+            commands.extend(schedule_commands(chan, entries))
+        await self.run_batch(commands)
+
+    async def saveconfig(self):
+        await self._run_command("SAVECONFIG")
+
+    async def loadconfig(self):
+        await self._run_command("LOADCONFIG")
+
+    async def set_binary(self, binary=True):
+        # The protocol is switched when the acknowledgement arrives
+        await self._run_command("PROTO", "BIN" if binary else "TEXT")
+
+    async def reset(self, hard=False):
+        if not hard:
+            await self._run_command("RESET")
+            await asyncio.sleep(1)
+            return await self.get_version()
+        else:
+            raise NotImplementedError("Hard reset not currently supported")
+
+    async def close(self):
+        self._shutdown(CommandError("Connection to board closed"))
+
+    async def start_async(self, cb=None):
+        if self._async_running:
+            raise Exception("Async updates already running")
+        if cb:
+            self.async_callback = cb
+        self._async_running = True
+        await self._run_command("ASYNC", "1")
+        await self.get_state("*")
+
+    async def stop_async(self):
+        self._async_running = False
+        await self._run_command("ASYNC", "0")
+
+_board_loop = None
+_board_loop_lock = threading.Lock()
+
+def board_event_loop():
+    """Return the event loop shared by all ThermoBoard objects, starting it if needed"""
+    global _board_loop
+    with _board_loop_lock:
+        if _board_loop is None:
+            _board_loop = asyncio.new_event_loop()
+            t = threading.Thread(target=_board_loop.run_forever, daemon=True, name="ThermoBoard loop")
+            t.start()
+    return _board_loop
+
+class ThermoBoard:
+    """Synchronous interface to a board, running an AsyncThermoBoard on a shared event loop"""
+    def __init__(self, path, binary=False, command_timeout=2.0):
+        self._loop = board_event_loop()
+        self._async_callback = None
+        self.board = self._call(AsyncThermoBoard.open(path, binary, command_timeout))
+        self.ID = self.board.ID
+
+    @classmethod
+    def wrap(cls, board):
+        """Return a ThermoBoard for an AsyncThermoBoard that is already open"""
+        self = cls.__new__(cls)
+        self._loop = board_event_loop()
+        self._async_callback = None
+        self.attach(board)
+        return self
+
+    def attach(self, board):
+        """Switch to a new connection to the board, after the old one was lost"""
+        self.board = board
+        self.ID = board.ID
+        if self._async_callback:
+            self.async_callback = self._async_callback
+
+    @property
+    def connected(self):
+        return self.board.connected
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    @property
+    def state_list(self):
+        return self.board.state_list
+
+    @property
+    def n_chan(self):
+        return self.board.n_chan
+
+    @property
+    def state_versions(self):
+        return self.board.state_versions
+
+    @property
+    def async_callback(self):
+        return self._async_callback
+
+    @async_callback.setter
+    def async_callback(self, cb):
+        # Callbacks are passed this object rather than the underlying board,
+        # and are run on the event loop thread
+        self._async_callback = cb
+        self.board.async_callback = (lambda b, chan, state: cb(self, chan, state)) if cb else None
+
+    def get_ID(self):
+        return self._call(self.board.get_ID())
+
+    def get_version(self):
+        return self._call(self.board.get_version())
+
+    def get_nchan(self):
+        return self._call(self.board.get_nchan())
+
+    def get_temp(self, channel):
+        return self._call(self.board.get_temp(channel))
+
+    def get_state(self, channel):
+        return self._call(self.board.get_state(channel))
+
+    def get_cached_state(self, channel):
+        if self.board._async_running:
+            # No need to involve the event loop just to read the cache
+            return self.board.cached_state(channel)
+        return self._call(self.board.get_cached_state(channel))
 
     def set_set_point(self, channel, temperature):
-        self._run_command("SET", channel, temperature, expect ="*")
+        self._call(self.board.set_set_point(channel, temperature))
 
     def set_override(self, channel, override):
-        override = OneZeroNone(override)
-        self._run_command("OVERRIDE", channel, override, expect ="*")
+        self._call(self.board.set_override(channel, override))
 
     def set_adjust(self, channel, offset):
-        self._run_command("ADJUST", channel, offset, expect ="*")
+        self._call(self.board.set_adjust(channel, offset))
+
+    def apply_settings(self, settings):
+        return self._call(self.board.apply_settings(settings))
+
+    @contextlib.contextmanager
+    def batch(self, atomic=False):
+        """Collect commands and send them together, in as few lines as
+        possible, when the with block ends
+
+        The responses are left in the batch's responses attribute."""
+        b = CommandBatch()
+        yield b
+        b.responses = self._call(self.board.run_batch(b.commands, atomic))
+
+    def get_time_constant(self, channel):
+        return self._call(self.board.get_time_constant(channel))
+
+    def set_time_constant(self, channel, seconds):
+        self._call(self.board.set_time_constant(channel, seconds))
+
+    def get_history(self, count=None):
+        return self._call(self.board.get_history(count))
+
+    def get_history_period(self):
+        return self._call(self.board.get_history_period())
+
+    def set_history_period(self, seconds):
+        self._call(self.board.set_history_period(seconds))
+
+    def get_history_length(self):
+        return self._call(self.board.get_history_length())
+
+    def set_history_length(self, count):
+        self._call(self.board.set_history_length(count))
+
+    def get_loopstats(self, reset=False):
+        return self._call(self.board.get_loopstats(reset))
+
+    def get_report_policy(self, channel):
+        return self._call(self.board.get_report_policy(channel))
+
+    def set_report_policy(self, channel, deadband=None, min_interval=None, max_interval=None, edge=None):
+        self._call(self.board.set_report_policy(channel, deadband, min_interval, max_interval, edge))
+
+    def get_clock(self):
+        return self._call(self.board.get_clock())
+
+    def set_clock(self, t=None):
+        self._call(self.board.set_clock(t))
+
+    def get_schedule(self, channel):
+        return self._call(self.board.get_schedule(channel))
+
+    def set_schedule(self, channel, entries):
+        self._call(self.board.set_schedule(channel, entries))
+
+    def set_schedules(self, schedules):
+        self._call(self.board.set_schedules(schedules))
 
     def saveconfig(self):
-        self._run_command("SAVECONFIG")
+        self._call(self.board.saveconfig())
 
     def loadconfig(self):
-        self._run_command("LOADCONFIG")
+        self._call(self.board.loadconfig())
+
+    def set_binary(self, binary=True):
+        self._call(self.board.set_binary(binary))
 
     def reset(self, hard=False):
-        if not hard:
-            self._run_command("RESET")
-            time.sleep(1)
-            self._drain()
-            return self.get_version()
-        else:
-            raise NotImplemented("Hard reset not currently supported")
-            
+        return self._call(self.board.reset(hard))
+
     def close(self):
-        self._s.close()
+        self._call(self.board.close())
 
     def start_async(self, cb=None):
-        if self._async_running:
-            raise Exception("Async thread already running")
         if cb:
             self.async_callback = cb
-        self._async_thread = threading.Thread(target=self._async_loop)
-        self._async_running = True
-        self._run_command("ASYNC", "1")
-        self.get_state("*")
-        self._async_thread.start()
+        self._call(self.board.start_async())
 
     def stop_async(self):
-        self._async_running = False
-        with self._cmd_lock:
-            self._s.write(b"\r\n")
-        self._async_thread.join()
-        self._async_thread = None
+        self._call(self.board.stop_async())
+
+
+class CommandBatch:
+    """Commands to be sent to a board together; see ThermoBoard.batch()"""
+    def __init__(self):
+        self.commands = []
+        self.responses = None
+
+    def add(self, cmd, *args):
+        self.commands.append((cmd,) + args)
+
+    def set_set_point(self, channel, temperature):
+        self.add("SET", channel, temperature)
+
+    def set_override(self, channel, override):
+        self.add("OVERRIDE", channel, OneZeroNone(override))
+
+    def set_adjust(self, channel, offset):
+        self.add("ADJUST", channel, offset)
+
+    def set_time_constant(self, channel, seconds):
+        self.add("FILTER", channel, seconds)
+
+    def set_schedule(self, channel, entries):
+        self.commands.extend(schedule_commands(channel, entries))
+
+    def set_report_policy(self, channel, deadband=None, min_interval=None, max_interval=None, edge=None):
+        self.add("REPORT", channel, *report_args(deadband, min_interval, max_interval, edge))
+
+    def get_state(self, channel):
+        self.add("STATE", channel)
+
+    def saveconfig(self):
+        self.add("SAVECONFIG")
+
+class BoardPool:
+    """Runs an operation on many boards at once on the shared event loop
+
+    Each board has its own deadline, so a slow or dead board delays the
+    result by no more than that. Operations return a dict of results and
+    a dict of exceptions, both keyed by board, so that the boards that
+    worked can be used even when others did not."""
+    def __init__(self, boards=(), deadline=5.0):
+        self._loop = board_event_loop()
+        self.boards = list(boards)
+        self.deadline = deadline
+
+    @classmethod
+    def open(cls, paths, binary=False, command_timeout=2.0, deadline=5.0):
+        """Open boards concurrently, returning the pool of those that opened
+        and a dict of exceptions keyed by the paths of those that did not"""
+        pool = cls(deadline=deadline)
+        opened, errors = pool._run(paths, lambda p: AsyncThermoBoard.open(p, binary, command_timeout), deadline)
+        pool.boards = [ThermoBoard.wrap(opened[p]) for p in paths if p in opened]
+        return pool, errors
+
+    async def _gather(self, items, fn, deadline):
+        async def one(item):
+            return await asyncio.wait_for(fn(item), deadline)
+        outcomes = await asyncio.gather(*[one(i) for i in items], return_exceptions=True)
+        results, errors = {}, {}
+        for item, r in zip(items, outcomes):
+            if isinstance(r, asyncio.TimeoutError):
+                errors[item] = CommandError("No response within {}s".format(deadline))
+            elif isinstance(r, BaseException):
+                errors[item] = r
+            else:
+                results[item] = r
+        return results, errors
+
+    def _run(self, items, fn, deadline=None):
+        deadline = self.deadline if deadline is None else deadline
+        return asyncio.run_coroutine_threadsafe(self._gather(list(items), fn, deadline), self._loop).result()
+
+    def map(self, fn, deadline=None, boards=None):
+        """Run fn(board) on every board, or on the given boards, concurrently,
+        where fn is passed the AsyncThermoBoard and returns a coroutine"""
+        return self._run(self.boards if boards is None else boards, lambda b: fn(b.board), deadline)
+
+    def saveconfig(self, deadline=None):
+        return self.map(lambda b: b.saveconfig(), deadline)
+
+    def loadconfig(self, deadline=None):
+        return self.map(lambda b: b.loadconfig(), deadline)
+
+    def set_clock(self, deadline=None):
+        return self.map(lambda b: b.set_clock(), deadline)
+
+    def get_history(self, count=None, deadline=None):
+        return self.map(lambda b: b.get_history(count), deadline)
+
+    def start_async(self, cb=None, deadline=None):
+        if cb:
+            for b in self.boards:
+                b.async_callback = cb
+        return self.map(lambda b: b.start_async(), deadline)
+
+    def stop_async(self, deadline=None):
+        return self.map(lambda b: b.stop_async(), deadline)
 
+    def close(self, deadline=None):
+        return self.map(lambda b: b.close(), deadline)